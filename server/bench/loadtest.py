@@ -0,0 +1,237 @@
+# End-to-end load test for trading and the market feed.
+#
+#   python -m bench.loadtest --users 200 --stocks 10 --subscribers 100 --duration 60
+#
+# Without --url the app is started in-process on a local port against a
+# fresh SQLite database (or --db) and an in-memory Redis stand-in (or
+# --cache host:port). With --url an already running deployment is driven
+# instead, and --admin-token is needed to create and verify the users; use
+# a fresh --prefix for every run against the same deployment.
+
+import argparse, asyncio, json, os, random, sys, tempfile, threading, time
+import httpx, websockets
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values: return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class Stats:
+    latency: dict[str, list[float]]
+    errors: dict[str, int]
+    ticks: dict[str, list[float]]
+    intervals: list[float]
+
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+        self.ticks = {}
+        self.intervals = []
+
+    async def timed(self, name: str, request):
+        start = time.perf_counter()
+        try:
+            res = await request
+            ok = res.status_code < 400 or res.status_code == 428
+        except httpx.HTTPError: res, ok = None, False
+
+        self.latency.setdefault(name, []).append(time.perf_counter() - start)
+        if not ok: self.errors[name] = self.errors.get(name, 0) + 1
+        return res
+
+    def report(self, duration: float) -> dict:
+        res = {}
+        for name, values in self.latency.items():
+            res[name] = {
+                "count": len(values), "errors": self.errors.get(name, 0),
+                "rps": len(values) / duration,
+                "p50_ms": percentile(values, 0.5) * 1e3, "p99_ms": percentile(values, 0.99) * 1e3
+            }
+
+        # a tick's delivery delay is measured from the first subscriber that
+        # received it, so it captures fan-out and queueing but not the
+        # provider's own compute time
+        spread = [t - min(times) for times in self.ticks.values() for t in times]
+        res['ticks'] = {
+            "count": len(self.ticks), "frames": len(spread),
+            "delay_p50_ms": percentile(spread, 0.5) * 1e3, "delay_p99_ms": percentile(spread, 0.99) * 1e3,
+            "interval_p50_ms": percentile(self.intervals, 0.5) * 1e3,
+            "interval_p99_ms": percentile(self.intervals, 0.99) * 1e3
+        }
+        return res
+
+
+def start_local(args) -> tuple[str, str]:
+    workdir = tempfile.mkdtemp(prefix='sms-bench-')
+    if args.db is not None: os.environ['DB_URL'] = args.db
+    else: os.environ.setdefault('DB_URL', f'sqlite:///{workdir}/bench.sqlite')
+    os.environ.setdefault('SECRET', 'bench')
+    os.environ.setdefault('ADMIN_USERNAME', 'admin')
+    os.environ.setdefault('ADMIN_PASSWORD', 'admin')
+    # SQLite serialises writers, so a single ledger shard avoids lock timeouts
+    if os.environ['DB_URL'].startswith('sqlite'): os.environ.setdefault('LEDGER_SHARDS', '1')
+
+    if args.cache is None:
+        import fakeredis, redis, redis.asyncio
+        from data import cache
+
+        server = fakeredis.FakeServer()
+        pool = redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=server)
+        async_pool = redis.asyncio.ConnectionPool(connection_class=fakeredis.FakeAsyncRedisConnection, server=server)
+        cache.get_pool = lambda: pool
+        cache.get_async_pool = lambda: async_pool
+    else:
+        host, port = args.cache.split(':')
+        os.environ['CACHE_HOST'], os.environ['CACHE_PORT'] = host, port
+
+    import jwt, uvicorn, main
+    seed(args.prefix, args.users, args.stocks)
+
+    config = uvicorn.Config(main.app, host='127.0.0.1', port=args.port, log_level='warning', ws_max_queue=1024)
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started: time.sleep(0.05)
+
+    admin = jwt.encode(
+        { "username": os.environ['ADMIN_USERNAME'], "password": os.environ['ADMIN_PASSWORD'] },
+        os.environ['SECRET'], algorithm='HS256'
+    )
+    return f'http://127.0.0.1:{args.port}', admin
+
+
+def seed(prefix: str, num_users: int, num_stocks: int):
+    import bcrypt, uuid
+    import sqlmodel as sql
+    from data.db import engine
+    from stock.models import Stock, StockEntry
+    from user.models import User
+
+    password = bcrypt.hashpw(b'bench', bcrypt.gensalt(4)).decode()
+    with sql.Session(engine) as session:
+        taken = set(session.exec(sql.select(User.username).where(User.username.startswith(prefix))).all()) # type: ignore
+        users = [
+            { "uid": uuid.uuid4(), "username": f'{prefix}{i}', "password": password, "balance": 100000.0, "verified": True }
+            for i in range(num_users) if f'{prefix}{i}' not in taken
+        ]
+        if users: session.execute(sql.insert(User), users)
+
+        existing = len(session.exec(sql.select(Stock)).all())
+        stocks = [Stock(name=f'Bench {i}', category='Bench') for i in range(existing, num_stocks)]
+        session.add_all(stocks)
+        session.flush()
+        session.add_all([StockEntry(stock_id=stock.uid, value=random.uniform(100, 5000)) for stock in stocks])
+        session.commit()
+
+
+def check(res: httpx.Response, action: str):
+    # numbers from a half set up run are meaningless, so setup fails fast
+    if not res.is_success: sys.exit(f'{action} failed with {res.status_code}: {res.text}')
+
+
+async def create_users(client: httpx.AsyncClient, admin: str, prefix: str, num_users: int):
+    for i in range(num_users):
+        check(await client.post('/user/signup', json={ "username": f'{prefix}{i}', "password": 'bench' }), f'signup of {prefix}{i}')
+        check(await client.put(f'/user/verify/{prefix}{i}', headers={ "user-token": admin }), f'verification of {prefix}{i}')
+
+
+async def login(client: httpx.AsyncClient, stats: Stats, prefix: str, i: int) -> str | None:
+    res = await stats.timed('login', client.post('/user/login', json={ "username": f'{prefix}{i}', "password": 'bench' }))
+    return None if res is None or res.status_code != 200 else res.json()['token']
+
+
+async def trader(client: httpx.AsyncClient, stats: Stats, token: str, stocks: list[str], deadline: float, think: float):
+    headers = { "user-token": token }
+    while time.monotonic() < deadline:
+        units = random.choice([-3, -2, -1, 1, 2, 3])
+        await stats.timed('transact', client.post(f'/stocks/transact/{random.choice(stocks)}', json={ "units": units }, headers=headers))
+        await asyncio.sleep(random.uniform(0, 2 * think))
+
+
+async def reader(client: httpx.AsyncClient, stats: Stats, deadline: float, think: float):
+    while time.monotonic() < deadline:
+        await stats.timed('leaderboard', client.get('/leaderboard', params={ "limit": 10 }))
+        await asyncio.sleep(random.uniform(0, 2 * think))
+
+
+async def subscriber(url: str, stats: Stats, deadline: float):
+    last = None
+    async with websockets.connect(url + '/stocks/', max_size=None) as socket:
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0: break
+            try: frame = await asyncio.wait_for(socket.recv(), timeout)
+            except asyncio.TimeoutError: break
+
+            now = time.monotonic()
+            stats.ticks.setdefault(frame, []).append(now) # type: ignore
+            if last is not None: stats.intervals.append(now - last)
+            last = now
+
+
+async def run(args, base: str, admin: str) -> dict:
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+        if args.url is not None: await create_users(client, admin, args.prefix, args.users)
+        check(await client.post('/stocks/', headers={ "user-token": admin }), 'starting the market')
+
+        start = time.monotonic()
+        tokens = await asyncio.gather(*[login(client, stats, args.prefix, i) for i in range(args.users)])
+        stocks = list((await client.get('/stocks/')).json().keys())
+
+        deadline = time.monotonic() + args.duration
+        ws_url = 'ws' + base[len('http'):]
+        tasks = [subscriber(ws_url, stats, deadline) for _ in range(args.subscribers)]
+        tasks += [trader(client, stats, token, stocks, deadline, args.think) for token in tokens if token is not None]
+        tasks += [reader(client, stats, deadline, args.think) for _ in range(args.readers)]
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        duration = time.monotonic() - start
+
+        if args.stop: await client.delete('/stocks/', headers={ "user-token": admin })
+
+    return stats.report(duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test trading and the market feed')
+    parser.add_argument('--url', help='drive a running server instead of starting one')
+    parser.add_argument('--admin-token', help='admin token for --url')
+    parser.add_argument('--db', help='database url for the local server (default: a fresh SQLite file)')
+    parser.add_argument('--cache', help='host:port of a Redis for the local server (default: in-memory)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--prefix', default='bench', help='username prefix of the generated users')
+    parser.add_argument('--stocks', type=int, default=5)
+    parser.add_argument('--subscribers', type=int, default=50)
+    parser.add_argument('--readers', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--think', type=float, default=0.5, help='mean pause between requests of one client')
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--stop', action='store_true', help='stop the stock provider afterwards')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    if args.url is None: base, admin = start_local(args)
+    elif args.admin_token is None: sys.exit('--admin-token is required with --url')
+    else: base, admin = args.url.rstrip('/'), args.admin_token
+
+    report = asyncio.run(run(args, base, admin))
+    if args.json: return print(json.dumps(report, indent=2))
+
+    print(f'{"":<12}{"count":>8}{"errors":>8}{"rps":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for name, row in report.items():
+        if name == 'ticks': continue
+        print(f'{name:<12}{row["count"]:>8}{row["errors"]:>8}{row["rps"]:>10.1f}{row["p50_ms"]:>10.1f}{row["p99_ms"]:>10.1f}')
+
+    ticks = report['ticks']
+    print(
+        f'ticks: {ticks["count"]} distinct, {ticks["frames"]} frames; '
+        f'delivery delay p50 {ticks["delay_p50_ms"]:.1f} ms, p99 {ticks["delay_p99_ms"]:.1f} ms; '
+        f'interval p50 {ticks["interval_p50_ms"]:.0f} ms, p99 {ticks["interval_p99_ms"]:.0f} ms'
+    )
+
+
+if __name__ == '__main__': main()
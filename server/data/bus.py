@@ -0,0 +1,54 @@
+import json, logging, threading, time, uuid
+from typing import Callable
+
+from data.cache import Cache, AsyncCache
+from data import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Every worker process subscribes to the same Redis channels: the process
+# that produces a frame or receives an admin request publishes it once and
+# each worker hands it to its own local sockets and state.
+class Bus(threading.Thread):
+    PREFIX = 'bus:'
+
+    id: str
+    __handlers: dict[str, Callable[[dict], None]]
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.__handlers = {}
+        super().__init__(daemon=True)
+
+    def subscribe(self, channel: str, handler: Callable[[dict], None]):
+        self.__handlers[channel] = handler
+
+    def publish(self, channel: str, message: dict):
+        Cache().client.publish(self.PREFIX + channel, json.dumps(message))
+
+    async def publish_async(self, channel: str, message: dict):
+        await AsyncCache().client.publish(self.PREFIX + channel, json.dumps(message))
+
+    def __dispatch(self, message: dict):
+        channel = message['channel'].decode()[len(self.PREFIX):]
+        handler = self.__handlers.get(channel)
+        if handler is None: return
+
+        # one bad message must not stop the subscription, but it is never
+        # dropped silently either
+        try: handler(json.loads(message['data']))
+        except Exception:
+            metrics.BUS_ERRORS.inc(channel=channel)
+            logger.exception('bus handler for %r failed', channel)
+
+    def run(self):
+        while True:
+            try:
+                pubsub = Cache().client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.PREFIX + '*')
+                for message in pubsub.listen(): self.__dispatch(message)
+
+            except Exception:
+                logger.exception('bus subscription lost, reconnecting')
+                time.sleep(1)
@@ -1,23 +1,60 @@
 import redis, os
-import json
+import redis.asyncio as aioredis
+from data import metrics
+
+class Connection(redis.Connection):
+    def send_packed_command(self, *args, **kwargs):
+        metrics.REDIS_ROUND_TRIPS.inc(client='sync')
+        return super().send_packed_command(*args, **kwargs)
+
+
+class AsyncConnection(aioredis.Connection):
+    async def send_packed_command(self, *args, **kwargs):
+        metrics.REDIS_ROUND_TRIPS.inc(client='async')
+        return await super().send_packed_command(*args, **kwargs)
+
+
+__pool: redis.ConnectionPool | None = None
+__async_pool: aioredis.ConnectionPool | None = None
+
+
+def get_pool() -> redis.ConnectionPool:
+    global __pool
+    if __pool is None:
+        __pool = redis.ConnectionPool(
+            host=os.environ['CACHE_HOST'],
+            port=int(os.environ['CACHE_PORT']),
+            connection_class=Connection
+        )
+    return __pool
+
+
+def get_async_pool() -> aioredis.ConnectionPool:
+    global __async_pool
+    if __async_pool is None:
+        __async_pool = aioredis.ConnectionPool(
+            host=os.environ['CACHE_HOST'],
+            port=int(os.environ['CACHE_PORT']),
+            connection_class=AsyncConnection
+        )
+    return __async_pool
+
 
 class Cache:
     __cache: redis.Redis
 
     def __init__(self):
-        self.__cache = redis.Redis(
-            host=os.environ['CACHE_HOST'], 
-            port=int(os.environ['CACHE_PORT'])
-        )
+        self.__cache = redis.Redis(connection_pool=get_pool())
+
+    @property
+    def client(self) -> redis.Redis: return self.__cache
 
-    def set(self, key: str, value: str):
-        self.__cache.set(key, value)
 
-    def get(self, key: str) -> str:
-        data: bytes | None = self.__cache.get(key) # type: ignore
-        if data is None: raise Exception(f"Key does not exist: {key}")
+class AsyncCache:
+    __cache: aioredis.Redis
 
-        return data.decode()
+    def __init__(self):
+        self.__cache = aioredis.Redis(connection_pool=get_async_pool())
 
-    def __del__(self):
-        self.__cache.close()
\ No newline at end of file
+    @property
+    def client(self) -> aioredis.Redis: return self.__cache
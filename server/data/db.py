@@ -1,8 +1,24 @@
 import sqlmodel as sql
 import os, uuid, pytz
 from datetime import datetime
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from data import metrics
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+def get_async_url(url: str) -> str:
+    scheme, rest = url.split('://', 1)
+    return f"{ASYNC_DRIVERS.get(scheme.split('+')[0], scheme)}://{rest}"
 
 engine = sql.create_engine(os.environ['DB_URL'])
+async_engine = create_async_engine(get_async_url(os.environ['DB_URL']))
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
 
 class BaseModel(sql.SQLModel):
     uid: uuid.UUID = sql.Field(default_factory=uuid.uuid4, primary_key=True)
@@ -26,3 +42,8 @@ def get_session():
         yield session
 
 
+async def get_async_session():
+    async with AsyncSession(async_engine) as session:
+        yield session
+
+
@@ -0,0 +1,131 @@
+import redis
+import sqlmodel as sql
+
+from data.cache import Cache, AsyncCache
+from data.socket_pool import SocketPool
+from stock import live, logic
+from user.models import User, Holding
+
+
+SETTLE = """
+if redis.call('exists', KEYS[1]) == 0 then return 0 end
+local price = tonumber(redis.call('hget', KEYS[2], ARGV[2]) or '0')
+redis.call('hincrby', KEYS[3], ARGV[1], ARGV[4])
+redis.call('zincrby', KEYS[1], tonumber(ARGV[3]) + tonumber(ARGV[4]) * price, ARGV[1])
+return 1
+"""
+
+UPDATE_PRICES = """
+if redis.call('exists', KEYS[1]) == 0 then return 0 end
+for i = 2, #ARGV, 2 do
+    local price = tonumber(ARGV[i + 1])
+    local old = tonumber(redis.call('hget', KEYS[2], ARGV[i]) or '0')
+    if price ~= old then
+        local holders = redis.call('hgetall', ARGV[1] .. ARGV[i])
+        for j = 1, #holders, 2 do
+            redis.call('zincrby', KEYS[1], tonumber(holders[j + 1]) * (price - old), holders[j])
+        end
+        redis.call('hset', KEYS[2], ARGV[i], ARGV[i + 1])
+    end
+end
+return 1
+"""
+
+
+class Leaderboard:
+    RANK = 'leaderboard:rank'
+    PRICE = 'leaderboard:price'
+    POSITIONS = 'leaderboard:positions:'
+
+    pool: SocketPool
+    __size: int
+    __top: dict[str, tuple[int, float]]
+
+    def __init__(self, pool: SocketPool, size: int = 100):
+        self.pool = pool
+        self.__size = size
+        self.__top = {}
+
+    # Scores are only built when there are none: once they exist, settles
+    # and price updates keep them current, and a rebuild over them would
+    # drop whatever settled while it read the database. Two builds racing
+    # each other leave the first one's scores.
+    def rebuild(self, session: sql.Session):
+        cache = Cache()
+        with cache.client.pipeline() as pipe:
+            pipe.watch(self.RANK)
+            if pipe.exists(self.RANK): return
+
+            scores = dict([
+                (user.username, user.balance) for user in
+                session.exec(sql.select(User).where(User.verified == True)).all()
+            ])
+            rows = session.exec(
+                sql.select(User, Holding)
+                .join(Holding)
+                .where(User.verified == True)
+            ).all()
+
+            stocks = list({holding.stock.hex for _, holding in rows})
+            prices = dict([(stock, price or 0) for stock, price in zip(stocks, live.prices(cache, stocks))])
+
+            positions: dict[str, dict[str, int]] = {}
+            for user, holding in rows:
+                scores[user.username] += logic.position_value(holding.short_balance, holding.quantity, prices[holding.stock.hex])
+                positions.setdefault(holding.stock.hex, {})[user.username] = holding.quantity
+
+            stale = [self.POSITIONS + key.decode() for key in pipe.hkeys(self.PRICE)] # type: ignore
+            pipe.multi()
+            pipe.delete(self.PRICE, *stale)
+            if prices: pipe.hset(self.PRICE, mapping=prices) # type: ignore
+            for stock, holders in positions.items(): pipe.hset(self.POSITIONS + stock, mapping=holders) # type: ignore
+            if scores: pipe.zadd(self.RANK, scores) # type: ignore
+            try: pipe.execute()
+            except redis.WatchError: pass
+
+    def add_user(self, username: str, balance: float):
+        if self.exists(): Cache().client.zadd(self.RANK, {username: balance}, nx=True)
+
+    def settle(self, username: str, cash: float, stock: str, units: int):
+        Cache().client.eval(
+            SETTLE, 3, self.RANK, self.PRICE, self.POSITIONS + stock,
+            username, stock, cash, units
+        )
+
+    def update_prices(self, prices: dict[str, float]):
+        if not prices: return
+        Cache().client.eval(
+            UPDATE_PRICES, 2, self.RANK, self.PRICE, self.POSITIONS,
+            *[value for item in prices.items() for value in item]
+        )
+
+    def exists(self) -> bool:
+        return bool(Cache().client.exists(self.RANK))
+
+    async def exists_async(self) -> bool:
+        return bool(await AsyncCache().client.exists(self.RANK))
+
+    def top(self, n: int | None = None) -> list[tuple[str, float]]:
+        if n is not None and n < 1: return []
+        rows = Cache().client.zrevrange(self.RANK, 0, -1 if n is None else n - 1, withscores=True)
+        return [(name.decode(), score) for name, score in rows] # type: ignore
+
+    async def top_async(self, n: int | None = None) -> list[tuple[str, float]]:
+        if n is not None and n < 1: return []
+        rows = await AsyncCache().client.zrevrange(self.RANK, 0, -1 if n is None else n - 1, withscores=True)
+        return [(name.decode(), score) for name, score in rows]
+
+    def ranks(self) -> dict[str, tuple[int, float]]:
+        return dict([(name, (rank, value)) for rank, (name, value) in enumerate(self.top(self.__size))])
+
+    async def ranks_async(self) -> dict[str, tuple[int, float]]:
+        return dict([(name, (rank, value)) for rank, (name, value) in enumerate(await self.top_async(self.__size))])
+
+    def diff(self) -> dict | None:
+        top = self.ranks()
+        changed = dict([(name, entry) for name, entry in top.items() if self.__top.get(name) != entry])
+        removed = [name for name in self.__top if name not in top]
+        self.__top = top
+
+        if changed or removed: return { "ranks": changed, "removed": removed }
+        return None
@@ -0,0 +1,188 @@
+import bisect, contextvars, threading, time
+from typing import Callable
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# A minimal in-process registry rendered in the Prometheus text format.
+# Every worker process keeps its own values.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REGISTRY: list['Metric'] = []
+
+
+def labels_str(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels: return ''
+    return '{%s}' % ','.join(['%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels])
+
+
+class Metric:
+    kind: str
+    name: str
+    help: str
+    _lock: threading.Lock
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> list[str]: raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+    __values: dict[tuple, float]
+
+    def __init__(self, name: str, help: str):
+        self.__values = {}
+        super().__init__(name, help)
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock: self.__values[key] = self.__values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock: values = list(self.__values.items())
+        return [f'{self.name}{labels_str(key)} {value}' for key, value in values]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    __sources: dict[tuple, Callable[[], float]]
+
+    def __init__(self, name: str, help: str):
+        self.__sources = {}
+        super().__init__(name, help)
+
+    def track(self, source: Callable[[], float], **labels):
+        self.__sources[tuple(sorted(labels.items()))] = source
+
+    def samples(self):
+        return [f'{self.name}{labels_str(key)} {source()}' for key, source in list(self.__sources.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    __buckets: tuple[float, ...]
+    __values: dict[tuple, tuple[list[int], list[float]]]
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = BUCKETS):
+        self.__buckets = buckets
+        self.__values = {}
+        super().__init__(name, help)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self.__values.setdefault(key, ([0] * (len(self.__buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.__buckets, value)] += 1
+            total[0] += value
+
+    def time(self, **labels) -> 'Timer': return Timer(self, labels)
+
+    def samples(self):
+        res = []
+        with self._lock: values = [(key, list(counts), total[0]) for key, (counts, total) in self.__values.items()]
+
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.__buckets, '+Inf'), counts):
+                cumulative += count
+                res.append(f'{self.name}_bucket{labels_str((*key, ("le", bound)))} {cumulative}')
+            res.append(f'{self.name}_sum{labels_str(key)} {total}')
+            res.append(f'{self.name}_count{labels_str(key)} {cumulative}')
+        return res
+
+
+class Timer:
+    __histogram: Histogram
+    __labels: dict
+    __start: float
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.__histogram = histogram
+        self.__labels = labels
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.__histogram.observe(time.perf_counter() - self.__start, **self.__labels)
+
+
+def render() -> str:
+    return '\n'.join([metric.render() for metric in REGISTRY]) + '\n'
+
+
+TICK_SECONDS = Histogram('market_tick_seconds', 'Time spent computing and publishing one tick')
+TICK_LAG_SECONDS = Histogram('market_tick_lag_seconds', 'Delay of a tick behind its schedule')
+BROADCAST_SECONDS = Histogram('socket_broadcast_seconds', 'Time spent fanning one frame out to local sockets')
+SOCKETS = Gauge('socket_clients', 'Connected websocket clients')
+TICK_HISTORY_BYTES = Gauge('tick_history_bytes', 'Memory reserved for the intraday tick history')
+REQUEST_SECONDS = Histogram('http_request_seconds', 'HTTP request latency')
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'Database queries issued per HTTP request',
+    (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+)
+REQUEST_DB_SECONDS = Histogram('http_request_db_seconds', 'Database time per HTTP request')
+DB_QUERIES = Counter('db_queries_total', 'Database queries')
+DB_SECONDS = Counter('db_query_seconds_total', 'Database query time')
+REDIS_ROUND_TRIPS = Counter('redis_round_trips_total', 'Redis round trips')
+BUS_ERRORS = Counter('bus_handler_errors_total', 'Bus messages whose handler raised')
+
+
+# per-request database usage, shared with threadpool and greenlet workers
+# through the copied context
+_usage: contextvars.ContextVar[list[float] | None] = contextvars.ContextVar('request_db', default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    DB_QUERIES.inc()
+    DB_SECONDS.inc(elapsed)
+
+    usage = _usage.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+def handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+def instrument_engine(engine: Engine):
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http': return await self.app(scope, receive, send)
+
+        usage = [0, 0.0]
+        token = _usage.set(usage)
+        start = time.perf_counter()
+        try: await self.app(scope, receive, send)
+        finally:
+            _usage.reset(token)
+            route = scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+            REQUEST_SECONDS.observe(time.perf_counter() - start, method=scope['method'], path=path)
+            REQUEST_QUERIES.observe(usage[0], path=path)
+            REQUEST_DB_SECONDS.observe(usage[1], path=path)
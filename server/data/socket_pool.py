@@ -1,21 +1,217 @@
 from fastapi import WebSocket
-import random
+import asyncio, json, random, struct
+from data import metrics
+
+
+class Client:
+    socket: WebSocket
+    queue: asyncio.Queue[str | bytes]
+    task: asyncio.Task
+
+    topics: set[str] | None
+    delta: bool
+    binary: bool
+    resync: bool
+
+    def __init__(self, socket: WebSocket, size: int):
+        self.socket = socket
+        self.queue = asyncio.Queue(size)
+
+        self.topics = None
+        self.delta = False
+        self.binary = False
+        self.resync = True
+
 
 class SocketPool:
-    __conn: list[WebSocket]
+    _conn: dict[WebSocket, Client]
+    __loop: asyncio.AbstractEventLoop | None
+    __size: int
+    __timeout: float
 
-    def __init__(self):
-        self.__conn = []
+    def __init__(self, size: int = 8, timeout: float = 5):
+        self._conn = {}
+        self.__loop = None
+        self.__size = size
+        self.__timeout = timeout
 
-    def add(self, socket: WebSocket):
-        self.__conn.append(socket)
+    def __len__(self): return len(self._conn)
+
+    def add(self, socket: WebSocket) -> Client:
+        self.__loop = asyncio.get_running_loop()
+        client = Client(socket, self.__size)
+        client.task = self.__loop.create_task(self.__write(client))
+        self._conn[socket] = client
+        return client
 
     def remove(self, socket: WebSocket):
-        self.__conn.remove(socket)
+        client = self._conn.pop(socket, None)
+        if client is not None and client.task is not asyncio.current_task(): client.task.cancel()
+
+    async def __write(self, client: Client):
+        try:
+            while True:
+                frame = await client.queue.get()
+                async with asyncio.timeout(self.__timeout):
+                    if isinstance(frame, bytes): await client.socket.send_bytes(frame)
+                    else: await client.socket.send_text(frame)
+
+        except asyncio.CancelledError: raise
+        except Exception:
+            self.remove(client.socket)
+            try: await client.socket.close()
+            except Exception: pass
+
+    def _push(self, client: Client, frame: str | bytes):
+        # a slow consumer keeps only its most recent frames, and delta
+        # subscribers get a full snapshot next to make up for the dropped one
+        if client.queue.full():
+            client.queue.get_nowait()
+            client.resync = True
+        client.queue.put_nowait(frame)
+
+    def __fanout(self, frame: str):
+        with metrics.BROADCAST_SECONDS.time(pool=type(self).__name__):
+            for client in list(self._conn.values()): self._push(client, frame)
+
+    def __send_random(self, frame: str):
+        if self._conn: self._push(random.choice(list(self._conn.values())), frame)
+
+    def _schedule(self, callback, *args):
+        if self.__loop is None or self.__loop.is_closed(): return
+
+        try: running = asyncio.get_running_loop()
+        except RuntimeError: running = None
+
+        if running is self.__loop: callback(*args)
+        else: self.__loop.call_soon_threadsafe(callback, *args)
+
+    def send(self, socket: WebSocket, message: dict):
+        # goes through the client's queue so that it is never written
+        # concurrently with, or after, a frame fanned out later
+        client = self._conn.get(socket)
+        if client is not None: self._schedule(self._push, client, json.dumps(message))
+
+    def publish(self, message: dict):
+        if self._conn: self._schedule(self.__fanout, json.dumps(message))
+
+    def publish_random(self, message: dict):
+        if self._conn: self._schedule(self.__send_random, json.dumps(message))
+
+
+FIELDS = ('open', 'high', 'low', 'close', 'time', 'volume')
+INTEGERS = ('time', 'volume')
+# a tick's volume is not a state that persists between frames, so it is
+# sent with every update instead of only when it differs
+UNDIFFED = ('volume',)
+
+
+def encode_json(topic: str, values: dict) -> str:
+    return f'{json.dumps(topic)}:{json.dumps(values)}'
+
+
+def encode_binary(topic: str, values: dict) -> bytes:
+    mask, data = 0, []
+    for bit, field in enumerate(FIELDS):
+        if field in values:
+            mask |= 1 << bit
+            data.append(struct.pack('<q' if field in INTEGERS else '<d', values[field]))
+
+    return bytes.fromhex(topic) + struct.pack('<B', mask) + b''.join(data)
+
+
+class Frame:
+    full: dict[str, dict]
+    delta: dict[str, dict]
+    __encoded: dict[tuple[bool, bool], dict]
+
+    def __init__(self, full: dict[str, dict], delta: dict[str, dict]):
+        self.full = full
+        self.delta = delta
+        self.__encoded = {}
+
+    def fragments(self, snapshot: bool, binary: bool) -> dict:
+        key = (snapshot, binary)
+        if key not in self.__encoded:
+            encode = encode_binary if binary else encode_json
+            self.__encoded[key] = dict([
+                (topic, encode(topic, values))
+                for topic, values in (self.full if snapshot else self.delta).items()
+            ])
+        return self.__encoded[key]
+
+
+# Per-topic market feed. Clients that never configure themselves receive
+# every update as one JSON object, as before. Configured clients can
+# subscribe to a subset of topics and ask for delta frames that carry only
+# the fields changed since the last frame, with a full snapshot on
+# (re)subscription, after a dropped frame and every `snapshot_every`
+# frames. JSON frames are {"type": "delta" | "snapshot", "data": {...}};
+# binary frames are a `<BI` (is_snapshot, count) header followed, per
+# topic, by its 16 uuid bytes, a bitmask over FIELDS and the present
+# fields (`<q` for time and volume, `<d` otherwise).
+class FeedPool(SocketPool):
+    __state: dict[str, dict]
+    __count: int
+    __snapshot_every: int
+
+    def __init__(self, snapshot_every: int = 30, **kwargs):
+        self.__state = {}
+        self.__count = 0
+        self.__snapshot_every = snapshot_every
+        super().__init__(**kwargs)
+
+    def configure(
+        self, socket: WebSocket, subscribe: list[str] | None = None, unsubscribe: list[str] | None = None,
+        delta: bool | None = None, binary: bool | None = None
+    ):
+        client = self._conn.get(socket)
+        if client is None: return
+
+        if subscribe is not None:
+            client.topics = set(subscribe) if client.topics is None else client.topics | set(subscribe)
+        if unsubscribe is not None and client.topics is not None:
+            client.topics -= set(unsubscribe)
+        if delta is not None: client.delta = delta
+        if binary is not None: client.binary = binary
+        client.resync = True
+
+    def publish_topics(self, updates: dict[str, dict]):
+        delta = {}
+        for topic, values in updates.items():
+            prev = self.__state.get(topic, {})
+            changed = dict([(key, value) for key, value in values.items() if key in UNDIFFED or prev.get(key) != value])
+            if changed: delta[topic] = changed
+            self.__state[topic] = values
+
+        # snapshots carry every topic's last values, not just this tick's
+        if not self._conn: return
+        self._schedule(self.__fanout_topics, Frame(dict(self.__state), delta), json.dumps(updates))
+
+    def __fanout_topics(self, frame: Frame, legacy: str):
+        with metrics.BROADCAST_SECONDS.time(pool=type(self).__name__): self.__fanout_frame(frame, legacy)
+
+    def __fanout_frame(self, frame: Frame, legacy: str):
+        self.__count += 1
+        periodic = self.__count % self.__snapshot_every == 0
+        cache: dict[tuple, str | bytes | None] = {}
+
+        for client in list(self._conn.values()):
+            if client.topics is None and not client.delta and not client.binary:
+                self._push(client, legacy)
+                continue
+
+            snapshot = client.resync or periodic or not client.delta
+            key = (snapshot, client.binary, None if client.topics is None else frozenset(client.topics))
+            if key not in cache: cache[key] = self.__encode(frame, *key)
+
+            client.resync = False
+            if cache[key] is not None: self._push(client, cache[key]) # type: ignore
 
-    async def random_send(self, message: dict):
-        await random.choice(self.__conn).send_json(message)
+    def __encode(self, frame: Frame, snapshot: bool, binary: bool, topics: frozenset | None):
+        fragments = frame.fragments(snapshot, binary)
+        selected = [fragment for topic, fragment in fragments.items() if topics is None or topic in topics]
+        if not selected and not snapshot: return None
 
-    async def broadcast(self, message: dict):
-        for socket in self.__conn:
-            await socket.send_json(message)
\ No newline at end of file
+        if binary: return struct.pack('<BI', snapshot, len(selected)) + b''.join(selected)
+        return '{"type": "%s", "data": {%s}}' % ('snapshot' if snapshot else 'delta', ','.join(selected))
@@ -1,7 +1,19 @@
 import data.db as db
+from sqlalchemy import inspect, text
 from user.models import *
 from stock.models import *
 db.sql.SQLModel.metadata.create_all(db.engine)
+# create_all skips existing tables, so columns and indexes added later are
+# created here
+for table in db.sql.SQLModel.metadata.sorted_tables:
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing or column.server_default is None: continue
+        with db.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE "%s" ADD COLUMN "%s" %s DEFAULT %s' % (
+                table.name, column.name, column.type.compile(db.engine.dialect), column.server_default.arg # type: ignore
+            )))
+    for index in table.indexes: index.create(db.engine, checkfirst=True)
 
 
 from fastapi import FastAPI
@@ -9,6 +21,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from user.views import router as user_routes
 from stock.views import router as stock_routes
 from misc_views import router as misc_routes
+from data.metrics import MetricsMiddleware
 
 
 app = FastAPI()
@@ -20,6 +33,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 app.include_router(user_routes, prefix='/user')
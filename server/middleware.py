@@ -4,21 +4,37 @@ import jwt, os, uuid
 import data.db as db
 from sqlalchemy.exc import NoResultFound
 from user.models import User
+from user import cache as user_cache
 
-def get_user(
+async def authenticate(user_token: str, session: db.AsyncSession) -> User:
+    try:
+        uid = user_cache.TOKENS.get(user_token)
+        if uid is None:
+            data = jwt.decode(user_token, os.environ['SECRET'], algorithms=['HS256'])
+            uid = uuid.UUID(data['uid'])
+            user_cache.TOKENS.set(user_token, uid)
+
+        user = await user_cache.get(uid)
+        if user is None:
+            version = await user_cache.version(uid)
+            res = await session.exec(db.sql.select(User).where(User.uid == uid))
+            user = res.one()
+            await user_cache.put(user, version)
+
+        return user
+
+    except (NoResultFound, jwt.InvalidTokenError):
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="Credential validation failed")
+
+
+async def get_user(
     user_token: str | None = Header(default=None),
-    session: db.sql.Session = Depends(db.get_session)
+    session: db.AsyncSession = Depends(db.get_async_session)
 ):
     if user_token is None:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="Credential validation failed")
-    
-    try:
-        data = jwt.decode(user_token, os.environ['SECRET'], algorithms=['HS256'])
-        res = session.exec(db.sql.select(User).where(User.uid == uuid.UUID(data['uid'])))
-        return res.one()
 
-    except (NoResultFound, jwt.InvalidTokenError):
-        raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="Credential validation failed")
+    return await authenticate(user_token, session)
 
 
 def check_admin(user_token: str | None = Header(default=None)):
@@ -1,37 +1,53 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from data import db
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from data import db, metrics
 from data.cache import Cache
-import middleware
-
-import stock.models as stock_models
-import user.models as user_models
+import middleware, uuid
+from stock.views import LEADERBOARD, BUS
 
 router = APIRouter()
 
+def rebuild_leaderboard():
+    with db.sql.Session(db.engine) as session: LEADERBOARD.rebuild(session)
+
+
 @router.get('/leaderboard')
-def get_leaderboard(session: db.sql.Session = Depends(db.get_session)):
-    res = {}
-    for user in session.exec(db.sql.select(user_models.User).where(user_models.User.verified == True)).all():
-        res[user.username] = user.balance
+async def get_leaderboard(limit: int | None = Query(default=None, ge=1, le=1000)):
+    if not await LEADERBOARD.exists_async(): await run_in_threadpool(rebuild_leaderboard)
+    return dict(await LEADERBOARD.top_async(limit))
 
-    for user, holding in session.exec(
-        db.sql.select(user_models.User, user_models.Holding)
-        .join(user_models.Holding)
-        .where(user_models.User.verified == True)
-    ).all():
-        cache_entry = Cache().get(holding.stock.hex)
-        res[user.username] += holding.quantity * \
-            (stock_models.StockEntry.from_json(holding.stock, cache_entry).close if cache_entry else 0)
 
-    return res
+@router.websocket('/leaderboard/')
+async def connect_leaderboard(websocket: WebSocket):
+    try:
+        await websocket.accept()
+        LEADERBOARD.pool.add(websocket)
+        LEADERBOARD.pool.send(websocket, { "ranks": await LEADERBOARD.ranks_async(), "removed": [] })
+        while True:
+            await websocket.receive_text()
+
+    except WebSocketDisconnect:
+        LEADERBOARD.pool.remove(websocket)
 
 
 
 
 from data.socket_pool import SocketPool
-import asyncio
 from typing import Dict, Any
 NEWS_POOL = SocketPool()
+metrics.SOCKETS.track(lambda: len(NEWS_POOL), pool='news')
+
+
+def on_news(message: dict):
+    if not message['random']: NEWS_POOL.publish(message['data'])
+    # a random item reaches one client overall: the first worker that has
+    # any clients claims it
+    elif len(NEWS_POOL) and Cache().client.set('news:' + message['id'], BUS.id, nx=True, ex=60):
+        NEWS_POOL.publish_random(message['data'])
+
+
+BUS.subscribe('news', on_news)
 
 @router.websocket('/news/')
 async def connect_websocket(websocket: WebSocket):
@@ -50,8 +66,10 @@ def broadcast_news(
     data: Dict[str, Any],
     _: None = Depends(middleware.check_admin),
 ):
-    if data.get("random", False):
-        asyncio.run(NEWS_POOL.random_send(data))
-    else:
-        asyncio.run(NEWS_POOL.broadcast(data))
-    return {"detail": "News broadcasted"}
\ No newline at end of file
+    BUS.publish('news', { "id": uuid.uuid4().hex, "random": data.get("random", False), "data": data })
+    return {"detail": "News broadcasted"}
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,379 @@
+import heapq, itertools, queue, threading, time, uuid, zlib
+from concurrent.futures import Future
+from typing import Callable
+
+from data.bus import Bus
+from data.cache import Cache, AsyncCache
+from . import live
+from .ledger import ShardedLedger, Leg, Batch, REJECTED, load_entry
+from .stock import RENEW
+
+
+class Order:
+    uid: uuid.UUID
+    user: uuid.UUID
+    stock: uuid.UUID
+    units: int
+    remaining: int
+    price: float | None
+    seq: int
+    cancelled: bool
+    reason: str | None
+
+    __seq = itertools.count()
+
+    def __init__(self, user: uuid.UUID, stock: uuid.UUID, units: int, price: float | None = None):
+        if units == 0: raise ValueError("Units cannot be zero")
+        if price is not None and price <= 0: raise ValueError("Limit price should be positive")
+
+        self.uid = uuid.uuid4()
+        self.user = user
+        self.stock = stock
+        self.units = units
+        self.remaining = abs(units)
+        self.price = price
+        self.seq = next(Order.__seq)
+        self.cancelled = False
+        self.reason = None
+
+    @property
+    def is_buy(self) -> bool: return self.units > 0
+
+    @property
+    def is_open(self) -> bool: return self.remaining > 0 and not self.cancelled
+
+    def crosses(self, price: float) -> bool:
+        if self.price is None: return True
+        return price <= self.price if self.is_buy else price >= self.price
+
+    def fill(self, units: int): self.remaining -= units
+
+    def cancel(self, reason: str | None = None):
+        self.cancelled = True
+        self.reason = reason
+
+    def to_dict(self): return {
+        "id": self.uid.hex, "stock": self.stock.hex,
+        "units": self.units, "remaining": self.remaining * (1 if self.is_buy else -1),
+        "price": self.price, "open": self.is_open, "reason": self.reason
+    }
+
+
+class OrderBook:
+    __bids: list[tuple[float, int, Order]]
+    __asks: list[tuple[float, int, Order]]
+
+    def __init__(self):
+        self.__bids = []
+        self.__asks = []
+
+    def __side(self, buy: bool): return self.__bids if buy else self.__asks
+
+    def __best(self, buy: bool) -> Order | None:
+        side = self.__side(buy)
+        while side and not side[0][2].is_open: heapq.heappop(side)
+        return side[0][2] if side else None
+
+    def rest(self, order: Order):
+        if order.price is None: raise ValueError("Market orders cannot rest on the book")
+        heapq.heappush(
+            self.__side(order.is_buy),
+            (-order.price if order.is_buy else order.price, order.seq, order)
+        )
+
+    # The resting order the next fill of `order` would be against, and its
+    # units, as long as it is no worse than the house `quote`. Nothing is
+    # filled here: the caller fills both orders once the trade has settled,
+    # or drops whichever side could not pay. A user's own resting orders are
+    # cancelled rather than traded against, and handed to `cancelled`.
+    def match(
+        self, order: Order, quote: float | None = None,
+        cancelled: Callable[[Order], None] = lambda _: None
+    ) -> tuple[Order, int] | None:
+        while order.is_open:
+            maker = self.__best(not order.is_buy)
+            if maker is None or not order.crosses(maker.price): return None # type: ignore
+            if quote is not None and (maker.price > quote if order.is_buy else maker.price < quote): return None # type: ignore
+            if maker.user != order.user: return maker, min(order.remaining, maker.remaining)
+            maker.cancel("Self-trade")
+            cancelled(maker)
+
+        return None
+
+    def crossed_by(self, price: float) -> list[Order]:
+        res = []
+        for buy in (True, False):
+            while (best := self.__best(buy)) is not None and best.crosses(price):
+                heapq.heappop(self.__side(buy))
+                res.append(best)
+
+        res.sort(key=lambda order: order.seq)
+        return res
+
+    def orders(self) -> list[Order]:
+        return [order for _, _, order in self.__bids + self.__asks if order.is_open]
+
+
+class MatchingEngine:
+    __books: dict[str, OrderBook]
+    __orders: dict[uuid.UUID, Order]
+    __prices: dict[str, float]
+    __queues: list[queue.Queue]
+    __ledger: ShardedLedger
+
+    def __init__(self, ledger: ShardedLedger, workers: int = 4):
+        self.__books = {}
+        self.__orders = {}
+        self.__prices = {}
+        self.__ledger = ledger
+        self.__queues = [queue.Queue() for _ in range(workers)]
+
+        for q in self.__queues:
+            threading.Thread(target=self.__work, args=(q,), daemon=True).start()
+
+    def __shard(self, stock: str) -> queue.Queue:
+        return self.__queues[zlib.crc32(stock.encode()) % len(self.__queues)]
+
+    def __put(self, stock: str, kind: str, payload) -> Future:
+        future = Future()
+        self.__shard(stock).put((kind, stock, payload, future))
+        return future
+
+    def submit(self, order: Order) -> Future:
+        self.__orders[order.uid] = order
+        return self.__put(order.stock.hex, 'order', order)
+
+    def cancel(self, order_uid: uuid.UUID, user: uuid.UUID) -> Future:
+        order = self.__orders.get(order_uid)
+        if order is None or order.user != user:
+            future = Future()
+            future.set_result(None)
+            return future
+
+        return self.__put(order.stock.hex, 'cancel', order)
+
+    def update_price(self, stock: str, price: float):
+        self.__put(stock, 'price', price)
+
+    def orders(self, user: uuid.UUID) -> list[Order]:
+        return sorted(
+            [order for order in list(self.__orders.values()) if order.user == user and order.is_open],
+            key=lambda order: order.seq
+        )
+
+    def __quote(self, stock: str) -> float:
+        if stock not in self.__prices:
+            price = live.prices(Cache(), [stock])[0]
+            if price is None: raise Exception(f"No live price for {stock}")
+            self.__prices[stock] = price
+        return self.__prices[stock]
+
+    def __leg(self, order: Order, units: int, per_unit: float, rate: float = 1.001) -> Leg:
+        return Leg(order.user, order.stock, units if order.is_buy else -units, per_unit, rate)
+
+    def __forget(self, order: Order):
+        if not order.is_open: self.__orders.pop(order.uid, None)
+
+    def __handle_order(self, book: OrderBook, stock: str, order: Order) -> list[dict]:
+        results = []
+        quote = self.__quote(stock)
+        # peer fills settle without slippage at the resting price, both sides
+        # in one atomic batch: a taker that cannot pay stops matching, and a
+        # maker that no longer can is dropped from the book. Makers priced
+        # worse than the house are left for the house to beat.
+        while (match := book.match(order, quote, self.__forget)) is not None:
+            maker, units = match
+            res, maker_res = self.__ledger.settle(Batch([
+                self.__leg(order, units, maker.price, rate=1), self.__leg(maker, units, maker.price, rate=1) # type: ignore
+            ], atomic=True)).result()
+
+            if res['valid']:
+                order.fill(units)
+                maker.fill(units)
+                results.append(res)
+            elif maker_res != REJECTED: maker.cancel(maker_res['message'])
+            else:
+                order.cancel(res['message'])
+                results.append(res)
+            self.__forget(maker)
+
+        if order.is_open:
+            if order.crosses(quote):
+                res = self.__ledger.settle(self.__leg(order, order.remaining, quote)).result()
+                if res['valid']: order.fill(order.remaining)
+                else: order.cancel(res['message'])
+                results.append(res)
+
+            else:
+                # a limit order only rests if it could be paid for at its price
+                res = self.__ledger.settle(Batch([self.__leg(order, order.remaining, order.price)], check=True)).result()[0] # type: ignore
+                if res['valid']: book.rest(order)
+                else:
+                    order.cancel(res['message'])
+                    results.append(res)
+
+        self.__forget(order)
+        return results
+
+    def __handle_price(self, book: OrderBook, stock: str, price: float):
+        self.__prices[stock] = price
+        # crossed orders settle together, but each is only marked filled, or
+        # cancelled with the reason, once its own result is known
+        crossed = book.crossed_by(price)
+        pending = [self.__ledger.settle(self.__leg(order, order.remaining, price)) for order in crossed]
+        for order, future in zip(crossed, pending):
+            try: res = future.result()
+            except Exception: res = { "valid": False, "message": "Settlement failed" }
+
+            if res['valid']: order.fill(order.remaining)
+            else: order.cancel(res['message'])
+            self.__forget(order)
+
+    def __work(self, q: queue.Queue):
+        while True:
+            kind, stock, payload, future = q.get()
+            book = self.__books.setdefault(stock, OrderBook())
+
+            try:
+                if kind == 'order': future.set_result(self.__handle_order(book, stock, payload))
+                elif kind == 'cancel':
+                    cancelled = payload.is_open
+                    if cancelled: payload.cancel()
+                    self.__forget(payload)
+                    future.set_result(payload if cancelled else None)
+                else:
+                    self.__handle_price(book, stock, payload)
+                    future.set_result(None)
+
+            except Exception as e: future.set_exception(e)
+
+
+class Unavailable(Exception): pass
+
+
+def then(future: Future, fn: Callable) -> Future:
+    res = Future()
+    def done(future: Future):
+        try: res.set_result(fn(future.result()))
+        except Exception as e: res.set_exception(e)
+    future.add_done_callback(done)
+    return res
+
+
+# Books and accounts have a single owner across worker processes: the worker
+# holding LEASE runs the matching engine and the ledger, and every other
+# worker forwards orders, cancels and batches to it over the bus and waits
+# for the reply. A standby takes over within `ttl` of the owner going away;
+# orders resting on the old owner's books do not survive the change.
+class Exchange(threading.Thread):
+    LEASE = 'engine:owner'
+    REQUESTS = 'engine:'
+    REPLIES = 'engine:reply:'
+    TIMEOUT = 10
+
+    id: str
+    serving: bool
+    __bus: Bus
+    __ledger: ShardedLedger
+    __engine: MatchingEngine | None
+    __pending: dict[str, Future]
+    __ttl: float
+    __interval: float
+
+    def __init__(self, bus: Bus, ledger: ShardedLedger, ttl: float = 1.5, interval: float = 0.5):
+        self.id = bus.id
+        self.serving = False
+        self.__bus = bus
+        self.__ledger = ledger
+        self.__engine = None
+        self.__pending = {}
+        self.__ttl = ttl
+        self.__interval = interval
+        super().__init__(daemon=True)
+
+        bus.subscribe(self.REQUESTS + self.id, self.__serve)
+        bus.subscribe(self.REPLIES + self.id, self.__reply)
+
+    async def submit(self, user: uuid.UUID, stock: uuid.UUID, units: int, price: float | None) -> Future:
+        return await self.__call('order', { "user": user.hex, "stock": stock.hex, "units": units, "price": price })
+
+    async def cancel(self, order: uuid.UUID, user: uuid.UUID) -> Future:
+        return await self.__call('cancel', { "order": order.hex, "user": user.hex })
+
+    async def orders(self, user: uuid.UUID) -> Future:
+        return await self.__call('orders', { "user": user.hex })
+
+    async def settle(self, batch: Batch) -> Future:
+        return await self.__call('settle', { "batch": batch.to_json() })
+
+    def update_price(self, stock: str, price: float):
+        if self.serving: self.__engine.update_price(stock, price) # type: ignore
+
+    def __run(self, op: str, args: dict) -> Future:
+        engine: MatchingEngine = self.__engine # type: ignore
+        if op == 'order':
+            order = Order(uuid.UUID(args['user']), uuid.UUID(args['stock']), args['units'], args['price'])
+            return then(engine.submit(order), lambda results: { "results": results, "order": order.to_dict() })
+        if op == 'cancel':
+            return then(engine.cancel(uuid.UUID(args['order']), uuid.UUID(args['user'])), lambda order: order and order.to_dict())
+        if op == 'settle': return self.__ledger.settle(load_entry(args['batch']))
+
+        future = Future()
+        future.set_result([order.to_dict() for order in engine.orders(uuid.UUID(args['user']))])
+        return future
+
+    # callers are on the event loop, so the owner is looked up and asked
+    # without blocking it
+    async def __call(self, op: str, args: dict) -> Future:
+        if self.serving: return self.__run(op, args)
+
+        future = Future()
+        owner = await AsyncCache().client.get(self.LEASE)
+        if owner is None:
+            future.set_exception(Unavailable())
+            return future
+
+        id = uuid.uuid4().hex
+        self.__pending[id] = future
+        future.add_done_callback(lambda _: self.__pending.pop(id, None))
+        await self.__bus.publish_async(self.REQUESTS + owner.decode(), { "id": id, "reply": self.id, "op": op, "args": args })
+        return future
+
+    def __serve(self, message: dict):
+        def reply(future: Future):
+            try: res = { "id": message['id'], "result": future.result() }
+            except Unavailable: res = { "id": message['id'], "unavailable": True }
+            except Exception as e: res = { "id": message['id'], "error": str(e) }
+            self.__bus.publish(self.REPLIES + message['reply'], res)
+
+        if self.serving: future = self.__run(message['op'], message['args'])
+        else:
+            future = Future()
+            future.set_exception(Unavailable())
+        future.add_done_callback(reply)
+
+    def __reply(self, message: dict):
+        future = self.__pending.get(message['id'])
+        if future is None or future.done(): return
+
+        if 'result' in message: future.set_result(message['result'])
+        elif message.get('unavailable'): future.set_exception(Unavailable())
+        else: future.set_exception(Exception(message['error']))
+
+    def poll(self):
+        cache = Cache()
+        ms = int(self.__ttl * 1000)
+        if self.serving: held = bool(cache.client.eval(RENEW, 1, self.LEASE, self.id, ms))
+        else: held = bool(cache.client.set(self.LEASE, self.id, nx=True, px=ms))
+
+        # a new owner replays the journals of the last one before serving
+        if held and not self.serving:
+            self.__ledger.start()
+            if self.__engine is None: self.__engine = MatchingEngine(self.__ledger)
+        self.serving = held
+
+    def run(self):
+        while True:
+            try: self.poll()
+            except Exception: self.serving = False
+            time.sleep(self.__interval)
@@ -0,0 +1,28 @@
+from data.cache import Cache
+
+
+# Order flow lives in Redis hashes so that legs settled by every worker
+# process nudge the prices of the single running provider. VOLUME keeps
+# the net units traded per stock since the last drain.
+class OrderFlow:
+    KEY = 'market:flow'
+    VOLUME = 'market:volume'
+
+    def add(self, legs: list[tuple[str, float, int]]):
+        if not legs: return
+        pipe = Cache().client.pipeline(transaction=False)
+        for stock, per_unit, units in legs:
+            pipe.hincrbyfloat(self.KEY, stock, per_unit * 0.001 * (1 if units > 0 else -1))
+            pipe.hincrby(self.VOLUME, stock, units)
+        pipe.execute()
+
+    def drain(self) -> tuple[dict[str, float], dict[str, int]]:
+        pipe = Cache().client.pipeline()
+        pipe.hgetall(self.KEY)
+        pipe.hgetall(self.VOLUME)
+        pipe.delete(self.KEY, self.VOLUME)
+        flow, volume, _ = pipe.execute()
+        return (
+            dict([(stock.decode(), float(value)) for stock, value in flow.items()]),
+            dict([(stock.decode(), int(value)) for stock, value in volume.items()])
+        )
@@ -1,7 +1,23 @@
-from pydantic import BaseModel
+import uuid
+from pydantic import BaseModel, Field
 
 class TransactForm(BaseModel):
     units: int
+    price: float | None = None
+
+class OrderForm(BaseModel):
+    stock: uuid.UUID
+    units: int
+
+class BatchForm(BaseModel):
+    orders: list[OrderForm] = Field(min_length=1, max_length=100)
+    atomic: bool = False
 
 class StockEventForm(BaseModel):
-    events: list[dict]
\ No newline at end of file
+    events: list[dict]
+
+class RatesForm(BaseModel):
+    update: float | None = None
+    trigger: float | None = None
+    stocks: dict[str, float | None] = {}
+    categories: dict[str, float | None] = {}
\ No newline at end of file
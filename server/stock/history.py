@@ -0,0 +1,110 @@
+import bisect, gzip, hashlib, json, os, threading, pytz, uuid
+from datetime import datetime
+import sqlmodel as sql
+
+from .models import Stock, StockEntry
+from .live import LiveCandle
+
+VERSION = 'history:version'
+RESOLUTIONS = { '1m': 60_000, '5m': 300_000, '1h': 3_600_000 }
+FIELDS = ('time', 'open', 'high', 'low', 'close')
+
+
+def to_datetime(time: int) -> datetime:
+    return datetime.fromtimestamp(time / 1000, tz=pytz.timezone('Asia/Kolkata'))
+
+
+def append(entries: list[dict], entry: dict, step: int | None = None):
+    time = entry['time'] if step is None else entry['time'] - entry['time'] % step
+    if not entries or entries[-1]['time'] != time:
+        entries.append({ **entry, 'time': time })
+        return
+
+    last = entries[-1]
+    if step is None: return
+
+    last['high'] = max(last['high'], entry['high'])
+    last['low'] = min(last['low'], entry['low'])
+    last['close'] = entry['close']
+
+
+def to_columnar(entries: list[dict]) -> dict[str, list]:
+    return dict([(field, [entry[field] for entry in entries]) for field in FIELDS])
+
+
+# The full history served to chart bootstraps. Stored candles are loaded
+# once and then only the rows newer than the last one are fetched whenever
+# the provider bumps VERSION at a candle close. Each entry is encoded once;
+# a rendered body, with the live candles appended, is gzipped once and
+# reused for as long as neither the history nor the live candles change.
+class Snapshot:
+    __lock: threading.Lock
+    __version: bytes | None
+    __latest: datetime | None
+    __names: dict[str, str]
+    __entries: dict[str, list[dict]]
+    __encoded: dict[str, list[str]]
+    __body: tuple[tuple, str, bytes, bytes] | None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__version = None
+        self.__latest = None
+        self.__names = {}
+        self.__entries = {}
+        self.__encoded = {}
+        self.__body = None
+
+    def stocks(self) -> list[str]: return list(self.__names)
+
+    def refresh(self, session: sql.Session, version: bytes | None) -> bool:
+        with self.__lock:
+            if self.__latest is not None and version == self.__version: return False
+
+            query = sql.select(StockEntry, Stock).join(Stock)
+            if self.__latest is not None: query = query.where(StockEntry.timestamp > self.__latest)
+
+            for entry, stock in session.exec(query.order_by(StockEntry.timestamp)): # type: ignore
+                stock_id = entry.stock_id.hex
+                if stock_id not in self.__names:
+                    self.__names[stock_id] = stock.name
+                    self.__entries[stock_id] = []
+                    self.__encoded[stock_id] = []
+
+                entries = self.__entries[stock_id]
+                count = len(entries)
+                append(entries, entry.to_dict())
+                if len(entries) > count: self.__encoded[stock_id].append(json.dumps(entries[-1]))
+                self.__latest = entry.timestamp if self.__latest is None else max(self.__latest, entry.timestamp)
+
+            # candles pruned by the provider's retention are dropped here too
+            oldest = session.exec(sql.select(sql.func.min(StockEntry.timestamp))).one() \
+                if os.environ.get('CANDLE_RETENTION_HOURS') else None
+            if oldest is not None:
+                cutoff = int(oldest.timestamp() * 1e3)
+                for stock_id, entries in self.__entries.items():
+                    count = bisect.bisect_left([entry['time'] for entry in entries], cutoff)
+                    del entries[:count], self.__encoded[stock_id][:count]
+
+            self.__version = version
+            return True
+
+    def render(self, live: dict[str, bytes | None]) -> tuple[str, bytes, bytes]:
+        with self.__lock:
+            key = (self.__version, self.__latest, *[live.get(stock_id) for stock_id in self.__names])
+            if self.__body is not None and self.__body[0] == key: return self.__body[1:]
+
+            parts = []
+            for stock_id, name in self.__names.items():
+                packed = live.get(stock_id)
+                encoded = self.__encoded[stock_id]
+                entries = self.__entries[stock_id]
+                candle = None if packed is None else LiveCandle.unpack(uuid.UUID(stock_id), packed)
+                if candle is not None and (not entries or candle.time != entries[-1]['time']):
+                    encoded = encoded + [json.dumps(candle.to_dict())]
+                parts.append('%s: {"name": %s, "entries": [%s]}' % (json.dumps(stock_id), json.dumps(name), ', '.join(encoded)))
+
+            raw = ('{%s}' % ', '.join(parts)).encode()
+            etag = '"%s"' % hashlib.sha1(raw).hexdigest()
+            self.__body = (key, etag, raw, gzip.compress(raw, mtime=0))
+            return self.__body[1:]
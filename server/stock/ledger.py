@@ -0,0 +1,324 @@
+import json, logging, os, queue, threading, time, uuid, zlib
+from contextlib import ExitStack
+from types import SimpleNamespace
+from typing import Callable
+import sqlmodel as sql
+from concurrent.futures import Future
+
+from user.models import User, Holding
+from user import cache as user_cache
+from data.db import engine, get_session
+from data.cache import Cache
+from data.leaderboard import Leaderboard
+from .flow import OrderFlow
+from .models import LedgerFlush
+from . import logic
+
+logger = logging.getLogger(__name__)
+
+
+class Leg:
+    uid: uuid.UUID
+    user: uuid.UUID
+    stock: uuid.UUID
+    units: int
+    per_unit: float
+    rate: float
+
+    def __init__(
+        self, user: uuid.UUID, stock: uuid.UUID, units: int, per_unit: float,
+        rate: float = 1.001, uid: uuid.UUID | None = None
+    ):
+        self.uid = uid or uuid.uuid4()
+        self.user = user
+        self.stock = stock
+        self.units = units
+        self.per_unit = per_unit
+        self.rate = rate
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "uid": self.uid.hex, "user": self.user.hex, "stock": self.stock.hex,
+            "units": self.units, "per_unit": self.per_unit, "rate": self.rate
+        })
+
+    @property
+    def legs(self) -> list['Leg']: return [self]
+
+    @property
+    def check(self) -> bool: return False
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            uuid.UUID(data['user']), uuid.UUID(data['stock']), data['units'],
+            data['per_unit'], data['rate'], uuid.UUID(data['uid'])
+        )
+
+
+# Legs settled together in order, of one user or of both sides of a trade.
+# An atomic batch is dry-run on copies of every account it touches first and
+# applied only if every leg is valid; a checked batch is only dry-run.
+class Batch:
+    legs: list[Leg]
+    atomic: bool
+    check: bool
+
+    def __init__(self, legs: list[Leg], atomic: bool = False, check: bool = False):
+        self.legs = legs
+        self.atomic = atomic
+        self.check = check
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "atomic": self.atomic, "check": self.check,
+            "legs": [json.loads(leg.to_json()) for leg in self.legs]
+        })
+
+
+# the result of the legs of an atomic batch that were not reached
+REJECTED = { "valid": False, "message": "Batch rejected" }
+
+
+def entry_from_dict(data: dict) -> Leg | Batch:
+    if 'legs' not in data: return Leg.from_dict(data)
+    return Batch([Leg.from_dict(leg) for leg in data['legs']], data['atomic'], data.get('check', False))
+
+
+def load_entry(json_str: str | bytes) -> Leg | Batch: return entry_from_dict(json.loads(json_str))
+
+
+def dump_flush(flush: uuid.UUID, entries: list[Leg | Batch]) -> str:
+    return json.dumps({ "id": flush.hex, "entries": [json.loads(entry.to_json()) for entry in entries] })
+
+
+def load_flush(json_str: str | bytes) -> tuple[uuid.UUID, list[Leg | Batch]]:
+    data = json.loads(json_str)
+    return uuid.UUID(data['id']), [entry_from_dict(entry) for entry in data['entries']]
+
+
+class DryRun:
+    def add_all(self, _): pass
+
+
+class Ledger(threading.Thread):
+    JOURNAL = 'ledger:journal:'
+
+    journal: str
+    lock: threading.Lock
+    __last: uuid.UUID | None
+    __locks: Callable[[list[uuid.UUID]], list[threading.Lock]]
+    __queue: queue.Queue[tuple[Leg | Batch, Future]]
+    __flow: OrderFlow
+    __leaderboard: Leaderboard
+    __size: int
+    __interval: float
+
+    def __init__(
+        self, flow: OrderFlow, leaderboard: Leaderboard, journal: str | None = None,
+        locks: Callable[[list[uuid.UUID]], list[threading.Lock]] | None = None,
+        size: int = 256, interval: float = 0.005
+    ):
+        self.journal = journal or self.JOURNAL + uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.__locks = locks or (lambda _: [self.lock])
+        self.__last = None
+        self.__queue = queue.Queue()
+        self.__flow = flow
+        self.__leaderboard = leaderboard
+        self.__size = size
+        self.__interval = interval
+        super().__init__(daemon=True)
+
+    def settle(self, entry: Leg | Batch) -> Future:
+        future = Future()
+        self.__queue.put((entry, future))
+        return future
+
+    def apply(
+        self, session: sql.Session, leg: Leg,
+        users: dict[uuid.UUID, User], holdings: dict[tuple[uuid.UUID, uuid.UUID], Holding]
+    ) -> tuple[dict, tuple | None]:
+        user, holding = users[leg.user], holdings.get((leg.user, leg.stock))
+        balance = user.balance
+        quantity, short_balance = (holding.quantity, holding.short_balance) if holding else (0, 0)
+
+        if leg.units > 0: res, holding = logic.buy_stock(user, leg.stock, leg.units, session, holding, leg.per_unit, leg.rate, leg.uid)
+        else: res, holding = logic.sell_stock(user, leg.stock, -leg.units, session, holding, leg.per_unit, leg.rate, leg.uid)
+        if not res['valid']: return res, None
+
+        holdings[(leg.user, leg.stock)] = holding # type: ignore
+        cash = res['balance'] - balance + logic.position_value(holding.short_balance - short_balance, 0, 0) # type: ignore
+        return res, (user.username, cash, leg.stock.hex, res['quantity'] - quantity)
+
+    def apply_batch(
+        self, session: sql.Session, batch: Batch,
+        users: dict[uuid.UUID, User], holdings: dict[tuple[uuid.UUID, uuid.UUID], Holding]
+    ) -> list[tuple[dict, tuple | None]]:
+        if (batch.atomic or batch.check) and batch.legs:
+            uids = {leg.user for leg in batch.legs}
+            scratch_users = dict([(uid, SimpleNamespace(**users[uid].model_dump())) for uid in uids])
+            scratch_holdings = dict([
+                (key, SimpleNamespace(**holding.model_dump())) for key, holding in holdings.items() if key[0] in uids
+            ])
+            dry = []
+            for i, leg in enumerate(batch.legs):
+                res, _ = self.apply(DryRun(), leg, scratch_users, scratch_holdings) # type: ignore
+                if not res['valid']: return [(res if j == i else dict(REJECTED), None) for j in range(len(batch.legs))]
+                dry.append((res, None))
+            if batch.check: return dry
+
+        return [self.apply(session, leg, users, holdings) for leg in batch.legs]
+
+    # `flush` is recorded as committed along with the entries, and `done`,
+    # a flush whose journal is already gone, is forgotten
+    def commit(
+        self, session: sql.Session, entries: list[Leg | Batch],
+        flush: uuid.UUID | None = None, done: uuid.UUID | None = None
+    ) -> list[list[dict]]:
+        # the rows are locked until the commit, so a second owner during a
+        # takeover waits for this one instead of overwriting it
+        uids = list({leg.user for entry in entries for leg in entry.legs})
+        users = dict([
+            (user.uid, user) for user in
+            session.exec(sql.select(User).where(User.uid.in_(uids)).with_for_update()) # type: ignore
+        ])
+        holdings = dict([
+            ((holding.user, holding.stock), holding) for holding in
+            session.exec(sql.select(Holding).where(Holding.user.in_(uids)).with_for_update()) # type: ignore
+        ])
+
+        try:
+            applied = [
+                self.apply_batch(session, entry, users, holdings) if isinstance(entry, Batch)
+                else [self.apply(session, entry, users, holdings)] for entry in entries
+            ]
+            if flush is not None: session.add(LedgerFlush(uid=flush))
+            if done is not None: session.exec(sql.delete(LedgerFlush).where(LedgerFlush.uid == done)) # type: ignore
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        # the flush is committed whatever happens to the caches, which are
+        # rebuilt or expire on their own
+        try:
+            user_cache.invalidate(*uids)
+            for _, delta in [item for results in applied for item in results]:
+                if delta is not None: self.__leaderboard.settle(*delta)
+        except Exception:
+            logger.exception('ledger caches not updated for %d users', len(uids))
+        return [[res for res, _ in results] for results in applied]
+
+    def recover(self, session: sql.Session, journal: str):
+        # a flush that committed left its id behind, whatever its entries'
+        # outcomes were, so rejected legs are never retried
+        cache = Cache()
+        for flush, entries in [load_flush(data) for data in cache.client.lrange(journal, 0, -1)]: # type: ignore
+            if session.get(LedgerFlush, flush) is None: self.commit(session, entries, flush)
+        cache.client.delete(journal)
+
+    def __commit(self, session: sql.Session, entries: list[Leg | Batch], flush: uuid.UUID) -> list[list[dict]]:
+        # entries spanning shards hold every shard they touch, always locked
+        # in shard order, while they commit
+        with ExitStack() as stack:
+            for lock in self.__locks([leg.user for entry in entries for leg in entry.legs]): stack.enter_context(lock)
+            return self.commit(session, entries, flush, self.__last)
+
+    def __flush(self, session: sql.Session, batch: list[tuple[Leg | Batch, Future]]):
+        # the flush is journaled under this shard's own key before it is
+        # applied and its id is committed along with it, so a crash in between
+        # is replayed on the next takeover exactly when the commit was lost.
+        # Whatever an earlier flush failed to clear is dropped as the journal
+        # is written, so the id of the last flush is kept only until the next
+        # one commits.
+        flush = uuid.uuid4()
+        entries = [entry for entry, _ in batch]
+        cache = Cache()
+
+        try:
+            cache.client.pipeline().delete(self.journal).rpush(self.journal, dump_flush(flush, entries)).execute()
+            results = self.__commit(session, entries, flush)
+            self.__last = flush
+        except Exception as e:
+            for _, future in batch: future.set_exception(e)
+            try: cache.client.delete(self.journal)
+            except Exception: logger.exception('ledger journal %s not cleared', self.journal)
+            return
+
+        try:
+            cache.client.delete(self.journal)
+            self.__flow.add([
+                (leg.stock.hex, leg.per_unit, leg.units)
+                for entry, entry_results in zip(entries, results) if not entry.check
+                for leg, res in zip(entry.legs, entry_results) if res['valid']
+            ])
+        except Exception: logger.exception('ledger flush %s committed with errors', flush)
+
+        for (entry, future), res in zip(batch, results):
+            future.set_result(res if isinstance(entry, Batch) else res[0])
+
+    def run(self):
+        session = next(get_session())
+        while True:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + self.__interval
+            while len(batch) < self.__size:
+                try: batch.append(self.__queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty: break
+
+            # nothing ends the shard, and every caller hears back
+            try: self.__flush(session, batch)
+            except Exception as e:
+                logger.exception('ledger flush failed')
+                for _, future in batch:
+                    if not future.done(): future.set_exception(e)
+
+
+# Accounts are sharded across single-writer ledgers by user uid: every leg
+# of one user is applied in order by the same thread, so balances and
+# holdings never race, while different users settle and commit in parallel.
+# An entry touching several shards, like both sides of a trade, is queued on
+# the lowest of them, which commits it while holding the others' locks.
+# Every process journals under its own id, so the journals of any other
+# process, however many shards it ran, are what an owner that went away
+# left behind.
+class ShardedLedger:
+    id: str
+    __shards: list[Ledger]
+    __started: bool
+
+    def __init__(self, flow: OrderFlow, leaderboard: Leaderboard, shards: int | None = None):
+        shards = shards or int(os.environ.get('LEDGER_SHARDS', os.cpu_count() or 1))
+        self.id = uuid.uuid4().hex
+        self.__shards = [
+            Ledger(flow, leaderboard, f'{Ledger.JOURNAL}{self.id}:{shard}', self.locks) for shard in range(shards)
+        ]
+        self.__started = False
+
+    def index(self, user: uuid.UUID) -> int: return zlib.crc32(user.bytes) % len(self.__shards)
+
+    def shard(self, user: uuid.UUID) -> Ledger: return self.__shards[self.index(user)]
+
+    def locks(self, users: list[uuid.UUID]) -> list[threading.Lock]:
+        return [self.__shards[i].lock for i in sorted({self.index(user) for user in users})]
+
+    def settle(self, entry: Leg | Batch) -> Future:
+        return self.__shards[min([self.index(leg.user) for leg in entry.legs])].settle(entry)
+
+    def recover(self):
+        journals = [
+            key.decode() for key in Cache().client.scan_iter(match=Ledger.JOURNAL + '*') # type: ignore
+            if not key.decode().startswith(f'{Ledger.JOURNAL}{self.id}:')
+        ]
+        with ExitStack() as stack, sql.Session(engine) as session:
+            for shard in self.__shards: stack.enter_context(shard.lock)
+            for journal in journals: self.__shards[0].recover(session, journal)
+
+    def start(self):
+        # replays what other processes left behind each time this one takes
+        # over, but starts the shards only once
+        self.recover()
+        if self.__started: return
+        self.__started = True
+        for shard in self.__shards: shard.start()
@@ -0,0 +1,88 @@
+import struct, uuid, pytz
+from datetime import datetime
+
+from data.cache import Cache, AsyncCache
+from .models import StockEntry
+
+# The open candle of every stock is kept packed in the CANDLES hash, and its
+# close again as a plain float in PRICES, so that readers who only need the
+# price never decode a candle.
+CANDLES = 'market:candles'
+PRICES = 'market:price'
+FORMAT = struct.Struct('<ddddq')
+
+
+# The candle being built by the provider. Updated on every tick, it is only
+# turned into a StockEntry once it closes.
+class LiveCandle:
+    __slots__ = ('stock_id', 'open', 'high', 'low', 'close', 'timestamp', 'time')
+
+    stock_id: uuid.UUID
+    open: float
+    high: float
+    low: float
+    close: float
+    timestamp: datetime
+    time: int
+
+    def __init__(self, stock_id: uuid.UUID, value: float, timestamp: datetime):
+        self.stock_id = stock_id
+        self.open = self.high = self.low = self.close = value
+        self.timestamp = timestamp
+        self.time = int(timestamp.timestamp() * 1e3)
+
+    def set_value(self, value: float):
+        if value <= 0: value = 1
+
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        self.close = value
+
+    def to_dict(self): return {
+        "open": self.open, "close": self.close,
+        "low": self.low, "high": self.high,
+        "time": self.time
+    }
+
+    def to_entry(self) -> StockEntry:
+        return StockEntry(
+            stock_id=self.stock_id, open=self.open, close=self.close,
+            low=self.low, high=self.high, timestamp=self.timestamp
+        )
+
+    def pack(self) -> bytes:
+        return FORMAT.pack(self.open, self.high, self.low, self.close, self.time)
+
+    @classmethod
+    def unpack(cls, stock_id: uuid.UUID, data: bytes) -> 'LiveCandle':
+        candle = cls.__new__(cls)
+        candle.stock_id = stock_id
+        candle.open, candle.high, candle.low, candle.close, candle.time = FORMAT.unpack(data)
+        candle.timestamp = datetime.fromtimestamp(candle.time / 1000, tz=pytz.timezone('Asia/Kolkata'))
+        return candle
+
+
+def store(cache: Cache, candles: list[LiveCandle]):
+    if not candles: return
+    pipe = cache.client.pipeline(transaction=False)
+    pipe.hset(CANDLES, mapping=dict([(candle.stock_id.hex, candle.pack()) for candle in candles])) # type: ignore
+    pipe.hset(PRICES, mapping=dict([(candle.stock_id.hex, candle.close) for candle in candles])) # type: ignore
+    pipe.execute()
+
+
+def candles(cache: Cache, stocks: list[str]) -> list[LiveCandle | None]:
+    if not stocks: return []
+    return [
+        None if data is None else LiveCandle.unpack(uuid.UUID(stock), data)
+        for stock, data in zip(stocks, cache.client.hmget(CANDLES, stocks)) # type: ignore
+    ]
+
+
+def prices(cache: Cache, stocks: list[str]) -> list[float | None]:
+    if not stocks: return []
+    return [None if data is None else float(data) for data in cache.client.hmget(PRICES, stocks)] # type: ignore
+
+
+async def prices_async(stocks: list[str]) -> list[float | None]:
+    if not stocks: return []
+    return [None if data is None else float(data) for data in await AsyncCache().client.hmget(PRICES, stocks)]
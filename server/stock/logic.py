@@ -1,108 +1,138 @@
 import sqlmodel as sql
+import uuid
 
-from .models import Stock, StockEntry
 from user.models import User, Holding, Transaction
-from data.cache import Cache
 
 def sumGP(a: float, n: int) -> float:
+    if a == 1: return n
     return a * (1 - a**n) / (1 - a)
 
+# What closing a position at `price` would add to the balance: a long sells
+# its units, and a short gets back its short balance along with the profit
+# on it, which is the short balance less the cost of buying the units back.
+# Net worth is the balance plus this over every holding.
+def position_value(short_balance, quantity, price):
+    return 2 * short_balance + quantity * price
+
+# Both functions validate the whole order before touching the user or the
+# holding, and only add the changed rows to the session: committing is left
+# to the caller so that many orders can share a single commit.
+
 def buy_stock(
-    user: User, stock: Stock, units: int,
-    session: sql.Session, holding: Holding | None
-):
-    per_unit = StockEntry.from_json(stock.uid, Cache().get(stock.uid.hex)).close
+    user: User, stock: uuid.UUID, units: int,
+    session: sql.Session, holding: Holding | None,
+    per_unit: float, rate: float = 1.001, uid: uuid.UUID | None = None
+) -> tuple[dict, Holding | None]:
     txn = Transaction(
+        uid=uid or uuid.uuid4(),
         user=user.uid,
-        stock=stock.uid,
+        stock=stock,
         num_units=units,
         price=per_unit
     )
 
-    if holding is not None and holding.quantity < 0:
-        num_units = min(units, -holding.quantity)
-        short_price = holding.short_balance / -holding.quantity
+    balance = user.balance
+    quantity = holding.quantity if holding is not None else 0
+    short_balance = holding.short_balance if holding is not None else 0
+    avg_price = holding.avg_price if holding is not None else 0
+    realized = holding.realized if holding is not None else 0
+
+    if quantity < 0:
+        num_units = min(units, -quantity)
+        short_price = short_balance / -quantity
         profit = num_units * (short_price - per_unit)
 
-        user.balance += profit + (num_units * short_price)
-        holding.short_balance -= num_units * short_price
-        holding.quantity += num_units
+        realized += profit
+        balance += profit + (num_units * short_price)
+        short_balance -= num_units * short_price
+        quantity += num_units
         units -= num_units
 
-    
+
     if units > 0:
-        price = per_unit * sumGP(1.001, units)
-        if (user.balance < price):
-            return { "valid": False, "message": "Insufficient balance" }
-        
-        user.balance -= price
+        price = per_unit * sumGP(rate, units)
+        if (balance < price):
+            return { "valid": False, "message": "Insufficient balance" }, holding
+
+        balance -= price
         if holding is None:
             holding = Holding(
                 user=user.uid,
-                stock=stock.uid,
-                quantity=units,
+                stock=stock,
+                quantity=0,
                 short_balance=0,
-                avg_price=price/units
+                avg_price=0
             )
+            avg_price = price/units
         else:
-            holding.avg_price = (holding.avg_price * holding.quantity + price) / (holding.quantity + units)
-            holding.quantity += units
-        
-        holding.save(session)
+            avg_price = (avg_price * quantity + price) / (quantity + units)
+        quantity += units
 
-    user.save(session)
-    txn.save(session)
-    return { 
-        "valid": True, "message": "Transaction successful!", 
-        "balance": user.balance, "avg_price": holding.avg_price # type: ignore
-    }
+    user.balance = balance
+    holding.quantity, holding.short_balance, holding.avg_price = quantity, short_balance, avg_price # type: ignore
+    holding.realized = realized # type: ignore
+    session.add_all([holding, user, txn])
+    return {
+        "valid": True, "message": "Transaction successful!",
+        "balance": user.balance, "avg_price": holding.avg_price, # type: ignore
+        "quantity": holding.quantity # type: ignore
+    }, holding
 
 
 def sell_stock(
-    user: User, stock: Stock, units: int,
-    session: sql.Session, holding: Holding | None
-):
-    per_unit = StockEntry.from_json(stock.uid, Cache().get(stock.uid.hex)).close
+    user: User, stock: uuid.UUID, units: int,
+    session: sql.Session, holding: Holding | None,
+    per_unit: float, rate: float = 1.001, uid: uuid.UUID | None = None
+) -> tuple[dict, Holding | None]:
     txn = Transaction(
+        uid=uid or uuid.uuid4(),
         user=user.uid,
-        stock=stock.uid,
+        stock=stock,
         num_units=-units,
         price=per_unit
     )
-    
+
+    balance = user.balance
+    quantity = holding.quantity if holding is not None else 0
+    short_balance = holding.short_balance if holding is not None else 0
+    avg_price = holding.avg_price if holding is not None else 0
+    realized = holding.realized if holding is not None else 0
+
     if holding is not None:
-        num_units = min(holding.quantity, units)
-        price = per_unit * sumGP(1/1.001, num_units)
+        num_units = min(quantity, units)
+        price = per_unit * sumGP(1/rate, num_units)
 
-        user.balance += price
-        holding.quantity -= num_units
+        if num_units > 0: realized += price - num_units * avg_price
+        balance += price
+        quantity -= num_units
         units -= num_units
-    
+
     if units > 0:
-        price = per_unit * sumGP(1/1.001, units)
-        if (user.balance < price):
-            return { "valid": False, "message": "Insufficient balance" }
-        
-        user.balance -= price
+        price = per_unit * sumGP(1/rate, units)
+        if (balance < price):
+            return { "valid": False, "message": "Insufficient balance" }, holding
+
+        balance -= price
         if holding is None:
             holding = Holding(
                 user=user.uid,
-                stock=stock.uid,
-                quantity=-units,
-                short_balance=price,
-                avg_price=price/units
+                stock=stock,
+                quantity=0,
+                short_balance=0,
+                avg_price=0
             )
+            avg_price = price/units
         else:
-            holding.avg_price = (holding.avg_price * -holding.quantity + price) / (-holding.quantity + units)
-            holding.quantity -= units
-            holding.short_balance += price
-            
-        holding.save(session)
-
-    user.save(session)
-    txn.save(session)
-    return { 
-        "valid": True, "message": "Transaction successful!", 
-        "balance": user.balance, "avg_price": holding.avg_price # type: ignore
-    }
-        
\ No newline at end of file
+            avg_price = (avg_price * -quantity + price) / (-quantity + units)
+        quantity -= units
+        short_balance += price
+
+    user.balance = balance
+    holding.quantity, holding.short_balance, holding.avg_price = quantity, short_balance, avg_price # type: ignore
+    holding.realized = realized # type: ignore
+    session.add_all([holding, user, txn])
+    return {
+        "valid": True, "message": "Transaction successful!",
+        "balance": user.balance, "avg_price": holding.avg_price, # type: ignore
+        "quantity": holding.quantity # type: ignore
+    }, holding
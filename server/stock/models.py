@@ -1,6 +1,5 @@
 import sqlmodel as sql
-import uuid, json, pytz
-from datetime import datetime
+import uuid, json
 from data.db import BaseModel, BaseTimestampModel
 
 
@@ -8,7 +7,16 @@ class Stock(BaseModel, table=True):
     name: str
     category: str
 
+# Ids of the ledger flushes that committed, written in the same transaction
+# as the flush, so that recovery replays exactly the flushes that did not.
+class LedgerFlush(BaseModel, table=True): pass
+
 class StockEntry(BaseTimestampModel, table=True):
+    __table_args__ = (
+        sql.Index('ix_stockentry_stock_id_timestamp', 'stock_id', 'timestamp'),
+        sql.Index('ix_stockentry_timestamp', 'timestamp'),
+    )
+
     stock_id: uuid.UUID = sql.Field(foreign_key='stock.uid', ondelete='CASCADE')
     open: float
     low: float
@@ -17,7 +25,7 @@ class StockEntry(BaseTimestampModel, table=True):
 
     def __init__(self, stock_id: uuid.UUID, value: float | None = None, **kwargs):
         if (value == None): super().__init__(stock_id=stock_id, **kwargs) # type: ignore
-        else: super().__init__(stock_id=stock_id, open=value, close=value, low=value, high=value) # type: ignore
+        else: super().__init__(stock_id=stock_id, open=value, close=value, low=value, high=value, **kwargs) # type: ignore
 
     def set_value(self, value: float):
         if value <= 0: value = 1
@@ -26,18 +34,6 @@ class StockEntry(BaseTimestampModel, table=True):
         self.high = max(self.high, value)
         self.close = value
 
-    @classmethod
-    def from_json(cls, stock_id: uuid.UUID, json_str: str | None):
-        if json_str == None: raise Exception("String cannot be none!")
-
-        data: dict[str, str | float] = json.loads(json_str)
-        return cls(
-            stock_id=stock_id,
-            open=float(data['open']), close=float(data['close']),
-            low=float(data['low']), high=float(data['high']),
-            timestamp=datetime.fromtimestamp(float(data['time'])/1000, tz=pytz.timezone('Asia/Kolkata'))
-        )
-    
     def to_dict(self): return {
         "open": self.open, "close": self.close,
         "low": self.low, "high": self.high,
@@ -185,7 +185,7 @@ def FALLING_WEDGE(value: float) -> List[Event]:
 
     for r in rel_targets:
         target = pole_top * r
-        events.append(Event(Event(random.randrange(4, 8), last, target)))
+        events.append(Event(random.randrange(4, 8), last, target))
         last = target
     events.append(Event(random.randrange(2,4), last,pole_top * 1 ))
     events.append(Event(random.randrange(1,3), pole_top * 1,pole_top * 0.955 ))
@@ -254,3 +254,20 @@ def INVERTED_CUP_AND_HANDLE(value : float) -> List[Event]:
     events.append(Event(random.randrange(10,15), value, value * (1 - random.uniform(0.08, 0.1))))
 
     return events
+
+
+PATTERNS = {
+    'bullish_flag': BULLISH_FLAG,
+    'bearish_flag': BEARISH_FLAG,
+    'bullish_pennant': BULLISH_PENNANT,
+    'bearish_pennant': BEARISH_PENNANT,
+    'double_top': DOUBLE_TOP,
+    'double_bottom': DOUBLE_BOTTOM,
+    'head_and_shoulders': HEAD_AND_SHOULDERS,
+    'inverse_head_and_shoulders': INVERSE_HEAD_AND_SHOULDERS,
+    'rising_wedge': RISING_WEDGE,
+    'falling_wedge': FALLING_WEDGE,
+    'rectangle': RECTANGLE,
+    'cup_and_handle': CUP_AND_HANDLE,
+    'inverted_cup_and_handle': INVERTED_CUP_AND_HANDLE,
+}
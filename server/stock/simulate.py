@@ -0,0 +1,146 @@
+# Deterministic, accelerated replay of the market on a virtual clock:
+#
+#   python -m stock.simulate --seed 7 --hours 8 --flow synthetic --out candles.jsonl
+#
+# Prices step exactly as in the live provider, but every random draw comes
+# from the seed and the clock only advances between ticks, so the same seed,
+# start and stocks always produce the same candles, as fast as they can be
+# computed. Candles are written in bulk to --out and, with --persist, to the
+# database.
+
+import argparse, hashlib, json, random, sys, threading, time, uuid
+import pytz
+from datetime import datetime
+from typing import Callable
+import sqlmodel as sql
+
+from data.db import engine
+from user.models import Transaction
+from .models import Stock, StockEntry
+from .stock import Market, Schedule, VirtualClock
+from .live import LiveCandle
+
+Flow = Callable[[float, Market], dict[str, float]]
+
+
+def synthetic_flow(rng: random.Random, rate: int) -> Flow:
+    # up to 2 * rate trades per stock and tick, each nudging the price like
+    # a settled leg does in OrderFlow
+    def flow(_: float, market: Market):
+        res = {}
+        for stock, entry in market.entries.items():
+            net = sum([rng.choice((-1, 1)) for _ in range(rng.randint(0, 2 * rate))])
+            if net: res[stock] = entry.close * 0.001 * net
+        return res
+    return flow
+
+
+def recorded_flow(session: sql.Session) -> Flow:
+    # settled transactions replayed at their offset from the first one
+    txns = session.exec(sql.select(Transaction).order_by(Transaction.timestamp)).all() # type: ignore
+    legs = [(
+        (txn.timestamp - txns[0].timestamp).total_seconds(), txn.stock.hex,
+        txn.price * 0.001 * (1 if txn.num_units > 0 else -1)
+    ) for txn in txns]
+    played = 0
+
+    def flow(now: float, _: Market):
+        nonlocal played
+        res = {}
+        while played < len(legs) and legs[played][0] <= now:
+            _, stock, value = legs[played]
+            res[stock] = res.get(stock, 0) + value
+            played += 1
+        return res
+    return flow
+
+
+def simulate(
+    market: Market, clock: VirtualClock, schedule: Schedule, duration: float,
+    flow: Flow, on_close: Callable[[list[StockEntry]], None]
+):
+    wake = threading.Event()
+    while (now := clock.monotonic()) < duration:
+        market.add_flow(flow(now, market))
+        closed, _, _ = market.tick(schedule, now, clock.now())
+        if closed: on_close(closed)
+        clock.wait(wake, schedule.next_deadline() - now)
+
+
+def initial_entries(session: sql.Session, rng: random.Random, num_stocks: int, start: datetime) -> list[LiveCandle]:
+    if num_stocks:
+        return [
+            LiveCandle(uuid.UUID(int=rng.getrandbits(128)), 5000.0, start)
+            for _ in range(num_stocks)
+        ]
+
+    stocks = session.exec(sql.select(Stock)).all()
+    return sorted([
+        LiveCandle(entry.stock_id, entry.close, start) for entry in session.exec(
+            sql.select(StockEntry)
+            .order_by(StockEntry.timestamp.desc())  # type: ignore
+            .limit(len(stocks))
+        ).all()
+    ], key=lambda entry: entry.stock_id.hex)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the market deterministically on a virtual clock')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hours', type=float, default=8)
+    parser.add_argument('--start', default='2025-01-01T09:15:00+05:30', help='ISO timestamp of the first candle')
+    parser.add_argument('--update', type=float, default=2, help='seconds between ticks')
+    parser.add_argument('--trigger', type=float, default=10, help='seconds per candle')
+    parser.add_argument('--rates', type=json.loads, help='JSON object of per-stock tick intervals')
+    parser.add_argument('--stocks', type=int, default=0, help='simulate N synthetic stocks instead of the stored ones')
+    parser.add_argument('--flow', choices=('none', 'synthetic', 'recorded'), default='synthetic')
+    parser.add_argument('--rate', type=int, default=3, help='mean synthetic trades per stock and tick')
+    parser.add_argument('--out', help='write the candles as JSON lines')
+    parser.add_argument('--persist', action='store_true', help='bulk insert the candles into the database')
+    parser.add_argument('--batch', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.persist and args.stocks: sys.exit('--persist needs stored stocks')
+
+    rng = random.Random(args.seed)
+    start = datetime.fromisoformat(args.start).astimezone(pytz.timezone('Asia/Kolkata'))
+    clock = VirtualClock(start)
+
+    session = sql.Session(engine)
+    market = Market(initial_entries(session, rng, args.stocks, start), rng)
+    if args.flow == 'synthetic': flow = synthetic_flow(random.Random(rng.getrandbits(64)), args.rate)
+    elif args.flow == 'recorded': flow = recorded_flow(session)
+    else: flow = lambda *_: {}
+
+    digest = hashlib.sha256()
+    out = open(args.out, 'w') if args.out else None
+    pending: list[dict] = []
+    count = 0
+
+    def flush():
+        if args.persist and pending:
+            session.execute(sql.insert(StockEntry), pending)
+            session.commit()
+        pending.clear()
+
+    def on_close(closed: list[StockEntry]):
+        nonlocal count
+        count += len(closed)
+        for entry in closed:
+            line = json.dumps({ "stock": entry.stock_id.hex, **entry.to_dict() })
+            digest.update(line.encode())
+            if out is not None: out.write(line + '\n')
+            if args.persist: pending.append(entry.model_dump())
+        if len(pending) >= args.batch: flush()
+
+    began = time.perf_counter()
+    schedule = Schedule(list(market.entries), args.update, args.trigger, 0, rates=args.rates)
+    simulate(market, clock, schedule, args.hours * 3600, flow, on_close)
+    flush()
+    if out is not None: out.close()
+    session.close()
+
+    print(f'{count} candles for {len(market.entries)} stocks in {time.perf_counter() - began:.2f}s, sha256 {digest.hexdigest()}')
+
+
+if __name__ == '__main__': main()
@@ -1,110 +1,368 @@
-import asyncio, random, threading, time
+import json, logging, os, queue, random, threading, time
+import pytz
+from datetime import datetime, timedelta
+from typing import Callable
+import numpy as np
+from collections import deque
 import sqlmodel as sql
-import datetime
-from datetime import timedelta
 from stock.models import Stock, StockEntry
-from user.models import Transaction, User, Holding
 
-from data.socket_pool import SocketPool
+from .flow import OrderFlow
+from data.bus import Bus
+from data.leaderboard import Leaderboard
 from data.cache import Cache
 from data.db import get_session
+from data import metrics
+from . import history, live
+from .live import LiveCandle
+
+logger = logging.getLogger(__name__)
 
 
 class Event:
-    _curr: int
-    _prev: float
     num_candles: int
     ends: tuple[float, float]
 
     def __init__(self, num_candles: int, data_from: float, data_to: float):
         if num_candles < 1: raise ValueError("Number of candles for transition should be atleast 1")
 
-        self._curr = 0
-        self._prev = data_from
         self.num_candles = num_candles
         self.ends = (data_from, data_to)
 
+
+class PricePath:
+    _curr: int
+    values: np.ndarray
+
+    def __init__(self, values: np.ndarray):
+        self._curr = 0
+        self.values = values
+
     def is_finished(self) -> bool:
-        return self._curr == self.num_candles
+        return self._curr == len(self.values)
 
     def get_next(self) -> float:
+        if self.is_finished(): raise IndexError("Exceeded the number of candles")
         self._curr += 1
-        if self._curr > self.num_candles: raise IndexError("Exceeded the number of candles")
-        if self._curr == self.num_candles: return self.ends[1]
-        lin_value = self.ends[0] + self._curr * (self.ends[1] - self.ends[0]) / self.num_candles
+        return float(self.values[self._curr - 1])
 
-        diff = min(lin_value - self.ends[0], self.ends[1] - lin_value) / 2
-        value = random.uniform(lin_value - diff, lin_value + diff)
-        self._prev = value
-        return value
+    def to_dict(self): return { "values": self.values.tolist(), "curr": self._curr }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        path = cls(np.array(data['values'], dtype=float))
+        path._curr = data['curr']
+        return path
 
-class StockProvider(threading.Thread):
-    __update: int
-    __trigger: int
-    __pool: SocketPool
 
-    __events: dict[str, list[Event]]
+def compile_paths(patterns: list[list[Event]], rng: np.random.Generator | None = None) -> list[PricePath]:
+    events = [event for pattern in patterns for event in pattern]
+    if not events: return [PricePath(np.empty(0)) for _ in patterns]
 
-    started: threading.Event
+    counts = np.array([event.num_candles for event in events])
+    ends = np.array([event.ends for event in events], dtype=float)
 
-    def __init__(self, update: int, trigger: int, pool: SocketPool):
-        self.__update = update
-        self.__trigger = trigger
-        self.__pool = pool
+    # step i of an event lands within half the distance to the nearer end of
+    # its linear interpolation, and the last step lands exactly on the target
+    seg = np.repeat(np.arange(len(events)), counts)
+    step = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    start, end, n = ends[seg, 0], ends[seg, 1], counts[seg]
 
-        self.__events = {}
-        self.started = threading.Event()
-    
-        super().__init__()
+    lin = start + step * (end - start) / n
+    diff = np.abs(np.minimum(lin - start, end - lin)) / 2
+    values = np.where(step == n, end, lin + (rng or np.random.default_rng()).uniform(-1, 1, len(seg)) * diff)
+
+    lengths = [sum(event.num_candles for event in pattern) for pattern in patterns]
+    return [PricePath(path) for path in np.split(values, np.cumsum(lengths)[:-1])]
+
+
+class Clock:
+    def monotonic(self) -> float: return time.monotonic()
+
+    def wait(self, wake: threading.Event, seconds: float) -> bool: return wake.wait(max(seconds, 0))
+
+    def now(self) -> datetime: return datetime.now(pytz.timezone('Asia/Kolkata'))
+
+
+# Time only moves when the loop waits, so a simulated session runs as fast
+# as the ticks can be computed.
+class VirtualClock(Clock):
+    __start: datetime
+    __elapsed: float
+
+    def __init__(self, start: datetime):
+        self.__start = start
+        self.__elapsed = 0
+
+    def monotonic(self) -> float: return self.__elapsed
+
+    def wait(self, wake: threading.Event, seconds: float) -> bool:
+        self.__elapsed += max(seconds, 0)
+        return wake.is_set()
+
+    def now(self) -> datetime: return self.__start + timedelta(seconds=self.__elapsed)
 
-    def add_pattern(self, stock_uid: str, events: list[Event]):
-        self.__events[stock_uid] = events
-
-    def __get_update(self, session: sql.Session, stock: Stock, timestamp: datetime.datetime,):
-        res = 0
-        txns = session.exec(
-            sql.select(Transaction)
-            .where(
-                Transaction.stock == stock.uid,
-                Transaction.timestamp >= timestamp
-            )
-        ).all()
-
-        for txn in txns:
-            res += txn.price * 0.001 * (1 if txn.num_units > 0 else -1)
-        
-        return res
-
-    def broadcast_updates(
-        self,  stocks: list[Stock], delta_time: float,
-        cache: Cache, session: sql.Session,
-        last_candle_update: bool
+
+# Tick deadlines on the monotonic clock. Every stock steps at its own rate
+# (falling back to `update`) and all candles close together every `trigger`
+# seconds; deadlines advance by whole periods, so the time spent computing a
+# tick never shifts the next one, and ticks missed while behind are dropped
+# instead of replayed in a burst.
+class Schedule:
+    update: float
+    trigger: float
+    rates: dict[str, float]
+    next_tick: dict[str, float]
+    next_close: float
+
+    def __init__(
+        self, stocks: list[str], update: float, trigger: float, now: float,
+        elapsed: float = 0, rates: dict[str, float] | None = None
     ):
+        self.update = update
+        self.trigger = trigger
+        self.rates = rates or {}
+        self.next_close = now - elapsed + trigger
+        self.next_tick = dict([(stock, now) for stock in stocks])
+
+    def rate(self, stock: str) -> float: return self.rates.get(stock, self.update)
+
+    def elapsed(self, now: float) -> float: return now - (self.next_close - self.trigger)
+
+    def set_rates(
+        self, now: float, update: float | None = None, trigger: float | None = None,
+        rates: dict[str, float] | None = None
+    ):
+        if update is not None: self.update = update
+        if trigger is not None:
+            self.next_close += trigger - self.trigger
+            self.trigger = trigger
+        if rates is not None: self.rates = rates
+
+        for stock in self.next_tick: self.next_tick[stock] = min(self.next_tick[stock], now + self.rate(stock))
+
+    def next_deadline(self) -> float:
+        return min([self.next_close, *[tick for tick in self.next_tick.values() if tick < self.next_close]])
+
+    def due(self, now: float) -> tuple[bool, list[str], set[str], float]:
+        if now >= self.next_close:
+            lag = now - self.next_close
+            while self.next_close <= now: self.next_close += self.trigger
+            start = self.next_close - self.trigger
+            for stock in self.next_tick: self.next_tick[stock] = start + self.rate(stock)
+            return True, [], set(), lag
+
+        due = [stock for stock, tick in self.next_tick.items() if tick <= now]
+        if not due: return False, [], set(), 0
+        lag = now - min([self.next_tick[stock] for stock in due])
+
+        last = set()
+        for stock in due:
+            tick = self.next_tick[stock] + self.rate(stock)
+            while tick <= now: tick += self.rate(stock)
+            self.next_tick[stock] = tick
+            if tick >= self.next_close: last.add(stock)
+        return False, due, last, lag
+
+
+# Price state of every stock, stepped by the provider and the simulator
+# alike. All randomness comes from `rng`, so a seeded market replays exactly.
+class Market:
+    entries: dict[str, LiveCandle]
+    events: dict[str, deque[PricePath]]
+    rng: random.Random
+    __flow: dict[str, float]
+    __volume: dict[str, int]
+
+    def __init__(self, entries: list[LiveCandle], rng: random.Random | None = None):
+        self.entries = dict([(entry.stock_id.hex, entry) for entry in entries])
+        self.events = dict([(stock, deque()) for stock in self.entries])
+        self.rng = rng or random.Random()
+        self.__flow = {}
+        self.__volume = {}
+
+    def add_pattern(self, stock_uid: str, path: PricePath):
+        self.events[stock_uid] = deque([path])
+
+    def add_flow(self, flow: dict[str, float], volume: dict[str, int] | None = None):
+        # flow is held until its stock next moves, which may be a few ticks
+        # away for slowly ticking stocks
+        for stock, value in flow.items(): self.__flow[stock] = self.__flow.get(stock, 0) + value
+        for stock, units in (volume or {}).items(): self.__volume[stock] = self.__volume.get(stock, 0) + units
+
+    def step(self, stocks: list[str], last: set[str]) -> dict[str, dict]:
         updates = {}
-                
         for stock in stocks:
-            entry = StockEntry.from_json(stock.uid, cache.get(stock.uid.hex))
+            entry = self.entries[stock]
+            events = self.events.setdefault(stock, deque())
             value = entry.close
 
-            if last_candle_update and len(self.__events[stock.uid.hex]) > 0:
-                value = self.__events[stock.uid.hex][0].get_next()
-                if self.__events[stock.uid.hex][0].is_finished():
-                    self.__events[stock.uid.hex].pop(0)
+            if stock in last and len(events) > 0:
+                value = events[0].get_next()
+                if events[0].is_finished(): events.popleft()
             else:
-                value += self.__get_update(
-                    session, stock,
-                    entry.timestamp + timedelta(seconds=delta_time - self.__update),
-                )
-                value += value * random.uniform(-0.01, 0.01)
-            
+                value += self.__flow.pop(stock, 0)
+                value += value * self.rng.uniform(-0.01, 0.01)
+
             entry.set_value(value)
-            updates[stock.uid.hex] = entry.to_dict()
-            cache.set(stock.uid.hex, str(entry))
-        
-        asyncio.run(self.__pool.broadcast(updates))
+            updates[stock] = { **entry.to_dict(), "volume": self.__volume.pop(stock, 0) }
+        return updates
+
+    def close(self, timestamp: datetime) -> tuple[list[StockEntry], dict[str, dict]]:
+        closed = [entry.to_entry() for entry in self.entries.values()]
+        for entry in list(self.entries.values()):
+            stock = entry.stock_id.hex
+            value = entry.close + self.__flow.pop(stock, 0) \
+                + abs(entry.open - entry.close) * self.rng.uniform(-0.1, 0.1)
+            self.entries[stock] = LiveCandle(entry.stock_id, value, timestamp)
+
+        return closed, dict([
+            (stock, { **entry.to_dict(), "volume": self.__volume.pop(stock, 0) }) for stock, entry in self.entries.items()
+        ])
+
+    def tick(self, schedule: Schedule, now: float, timestamp: datetime) -> tuple[list[StockEntry], dict[str, dict], float]:
+        close, stocks, last, lag = schedule.due(now)
+        if close: return *self.close(timestamp), lag
+        return [], self.step(stocks, last), lag
+
+
+# The provider checkpoints its position within the candle and its queued
+# events to STATE after every tick, so that a provider started by another
+# process after a failover resumes from the live candles in the cache
+# instead of reseeding them from the database. Tick rates set through the
+# admin API are kept in RATES and survive restarts; changes arrive on the bus
+# thread and are queued until the provider's own loop applies them between
+# ticks. A provider started by the Elector is fenced by its `owner` token:
+# frames are stored and published, and checkpoints written, only while the
+# lease still names it, and it stops itself as soon as it does not.
+class StockProvider(threading.Thread):
+    STATE = 'provider:state'
+    RATES = 'provider:rates'
+
+    __update: float
+    __trigger: float
+    __bus: Bus
+    __flow: OrderFlow
+    __leaderboard: Leaderboard
+    __retention: timedelta | None
+    __clock: Clock
+    __rng: random.Random
+    __pending: dict[str, PricePath]
+    __wake: threading.Event
+    __rates: queue.SimpleQueue
+    __owner: str | None
 
+    market: Market | None
+    schedule: Schedule | None
+    started: threading.Event
+
+    def __init__(
+        self, update: float, trigger: float, bus: Bus,
+        flow: OrderFlow, leaderboard: Leaderboard, retention: float | None = None,
+        clock: Clock | None = None, seed: int | None = None, owner: str | None = None
+    ):
+        retention = retention or float(os.environ.get('CANDLE_RETENTION_HOURS', 0))
+        self.__retention = timedelta(hours=retention) if retention else None
+        self.__update = update
+        self.__trigger = trigger
+        self.__bus = bus
+        self.__flow = flow
+        self.__leaderboard = leaderboard
+        self.__clock = clock or Clock()
+        self.__rng = random.Random(seed)
+        self.__pending = {}
+        self.__wake = threading.Event()
+        self.__rates = queue.SimpleQueue()
+        self.__owner = owner
+
+        self.market = None
+        self.schedule = None
+        self.started = threading.Event()
     
+        super().__init__()
+
+    def add_pattern(self, stock_uid: str, path: PricePath):
+        if self.market is None: self.__pending[stock_uid] = path
+        else: self.market.add_pattern(stock_uid, path)
+
+    def set_rates(self, rates: dict):
+        self.__rates.put(rates)
+        self.__wake.set()
+
+    def stop(self):
+        self.started.clear()
+        self.__wake.set()
+
+    def holds(self, cache: Cache) -> bool:
+        if self.__owner is None or cache.client.get(Elector.LEASE) == self.__owner.encode(): return True
+        self.stop()
+        return False
+
+    def checkpoint(self, cache: Cache, delta_time: float):
+        state = {
+            "delta_time": delta_time,
+            "events": json.dumps(dict([
+                (stock, [path.to_dict() for path in paths]) for stock, paths in list(self.market.events.items()) # type: ignore
+            ]))
+        }
+        if self.__owner is None: return cache.client.hset(self.STATE, mapping=state) # type: ignore
+
+        if not cache.client.eval(CHECKPOINT, 2, Elector.LEASE, self.STATE, self.__owner, *[value for item in state.items() for value in item]):
+            self.stop()
+
+    def persist(self, session: sql.Session, entries: list[StockEntry]):
+        # closed candles go out in one bulk insert, and candles older than
+        # the retention window are pruned in the same transaction
+        session.add_all(entries)
+        if self.__retention is not None:
+            session.exec(sql.delete(StockEntry).where( # type: ignore
+                StockEntry.timestamp < self.__clock.now() - self.__retention # type: ignore
+            ))
+        session.commit()
+
+    def publish(self, cache: Cache, updates: dict[str, dict]):
+        candles = [self.market.entries[stock] for stock in updates] # type: ignore
+        if self.__owner is None:
+            live.store(cache, candles)
+            self.__bus.publish('feed', updates)
+
+        elif not cache.client.eval(
+            PUBLISH, 4, Elector.LEASE, live.CANDLES, live.PRICES, Bus.PREFIX + 'feed', self.__owner, json.dumps(updates),
+            *[value for candle in candles for value in (candle.stock_id.hex, candle.pack(), candle.close)]
+        ):
+            self.stop()
+            return
+
+        self.__leaderboard.update_prices(dict([(stock, entry['close']) for stock, entry in updates.items()]))
+        diff = self.__leaderboard.diff()
+        if diff is not None: self.__bus.publish('leaderboard', diff)
+
+    def load(self, session: sql.Session, cache: Cache) -> float:
+        stocks = list(session.exec(sql.select(Stock)).fetchall())
+
+        # on failover the live candles in the cache are the current state,
+        # otherwise every stock restarts from its last stored close
+        state = cache.client.hgetall(self.STATE)
+        entries = [entry for entry in live.candles(cache, [stock.uid.hex for stock in stocks]) if entry is not None]
+        if state and entries:
+            self.market = Market(entries, self.__rng)
+            for stock, paths in json.loads(state[b'events']).items(): # type: ignore
+                self.market.events[stock] = deque([PricePath.from_dict(path) for path in paths])
+            delta_time = float(state[b'delta_time']) # type: ignore
+
+        else:
+            self.market = Market([
+                LiveCandle(entry.stock_id, entry.close, self.__clock.now()) for entry in session.exec(
+                    sql.select(StockEntry)
+                    .order_by(StockEntry.timestamp.desc())  # type: ignore
+                    .limit(len(stocks))
+                ).all()
+            ], self.__rng)
+            live.store(cache, list(self.market.entries.values()))
+            delta_time = 0
+
+        for stock, path in self.__pending.items(): self.market.add_pattern(stock, path)
+        return delta_time
 
     def run(self):
         if self.started.is_set(): return None
@@ -112,51 +370,145 @@ class StockProvider(threading.Thread):
 
         cache = Cache()
         session = next(get_session())
-        stocks = list(session.exec(sql.select(Stock)).fetchall())
-        
-        for entry in session.exec(
-            sql.select(StockEntry)
-            .order_by(StockEntry.timestamp.desc())  # type: ignore
-            .limit(len(stocks))
-        ).all():
-            cache.set(
-                entry.stock_id.hex, 
-                str(StockEntry(
-                    entry.stock_id,
-                    value=entry.close
-                ))
-            )
-            self.__events[entry.stock_id.hex] = []
-            pass
-
-        delta_time = 0
+        delta_time = self.load(session, cache)
+        market: Market = self.market # type: ignore
+
+        rates = json.loads(cache.client.get(self.RATES) or '{}') # type: ignore
+        schedule = Schedule(
+            list(market.entries), rates.get('update', self.__update), rates.get('trigger', self.__trigger),
+            self.__clock.monotonic(), delta_time, rates.get('stocks')
+        )
+        self.schedule = schedule
+
+        self.__leaderboard.rebuild(session)
         while self.started.is_set():
-                        
-            if delta_time == self.__trigger:
-                delta_time = 0
-                new_data = {}
-                for stock in stocks:
-                    entry = StockEntry.from_json(stock.uid, cache.get(stock.uid.hex))
-                    entry.save(session)
-
-                    value = entry.close + self.__get_update(
-                        session, stock, 
-                        entry.timestamp + timedelta(seconds=self.__trigger - self.__update)
-                    ) + abs(entry.open - entry.close) * random.uniform(-0.1, 0.1)
-                    
-                    new_entry = StockEntry(stock_id=stock.uid, value=value)
-                    cache.set(stock.uid.hex, str(new_entry))
-                    new_data[stock.uid.hex] = new_entry.to_dict()
-
-                asyncio.run(self.__pool.broadcast(new_data))
-
-            else: self.broadcast_updates(
-                stocks, delta_time, cache, session,
-                last_candle_update=(delta_time + self.__update == self.__trigger)
-            )
-
-
-            time.sleep(self.__update)
-            delta_time += self.__update
-
-        session.close()
\ No newline at end of file
+            self.__wake.clear()
+            tick = self.__clock.monotonic()
+            while not self.__rates.empty():
+                rates = self.__rates.get()
+                schedule.set_rates(tick, rates.get('update'), rates.get('trigger'), rates.get('stocks'))
+            # a failed tick is retried on the next one, the elector decides
+            # whether this provider keeps running
+            try:
+                market.add_flow(*self.__flow.drain())
+                closed, updates, lag = market.tick(schedule, tick, self.__clock.now())
+
+                if updates:
+                    metrics.TICK_LAG_SECONDS.observe(lag)
+                    if closed:
+                        # the database cannot be fenced by the lease, so it is
+                        # only checked right before
+                        if not self.holds(cache): break
+                        self.persist(session, closed)
+                        cache.client.incr(history.VERSION)
+                    self.publish(cache, updates)
+                    self.checkpoint(cache, schedule.elapsed(tick))
+                    metrics.TICK_SECONDS.observe(self.__clock.monotonic() - tick)
+            except Exception:
+                logger.exception('stock tick failed')
+                session.rollback()
+
+            self.__clock.wait(self.__wake, schedule.next_deadline() - self.__clock.monotonic())
+
+        session.close()
+
+
+RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end
+return 0
+"""
+
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+return 0
+"""
+
+# stores the (stock, packed candle, close) triples after the message and
+# publishes the message, only while the lease is held
+PUBLISH = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then return 0 end
+for i = 3, #ARGV, 3 do
+    redis.call('hset', KEYS[2], ARGV[i], ARGV[i + 1])
+    redis.call('hset', KEYS[3], ARGV[i], ARGV[i + 2])
+end
+redis.call('publish', KEYS[4], ARGV[2])
+return 1
+"""
+
+CHECKPOINT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('hset', KEYS[2], unpack(ARGV, 2))
+return 1
+"""
+
+
+# Every worker runs an elector. While the market is RUNNING, the worker that
+# holds the LEASE runs the provider and renews the lease every `interval`;
+# the others retry acquiring it, so a standby takes over within `ttl` plus
+# one `interval` of the leader going away. A leader that cannot renew the
+# lease, or cannot reach Redis at all, stops its provider.
+class Elector(threading.Thread):
+    RUNNING = 'provider:running'
+    LEASE = 'provider:owner'
+
+    id: str
+    provider: StockProvider | None
+    __factory: Callable[[], StockProvider]
+    __ttl: float
+    __interval: float
+    __lock: threading.Lock
+
+    def __init__(self, id: str, factory: Callable[[], StockProvider], ttl: float = 1.5, interval: float = 0.5):
+        self.id = id
+        self.provider = None
+        self.__factory = factory
+        self.__ttl = ttl
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        super().__init__(daemon=True)
+
+    def __join(self):
+        if self.provider is None: return
+
+        self.provider.stop()
+        if self.provider.is_alive(): self.provider.join()
+        self.provider = None
+
+    def __stop(self, clean: bool):
+        if self.provider is None: return
+        self.__join()
+
+        cache = Cache()
+        if clean: cache.client.delete(StockProvider.STATE)
+        cache.client.eval(RELEASE, 1, self.LEASE, self.id)
+
+    def poll(self):
+        with self.__lock:
+            cache = Cache()
+            if not cache.client.exists(self.RUNNING): return self.__stop(clean=True)
+
+            ms = int(self.__ttl * 1000)
+            # a provider that died is not renewed, the lease goes to whoever
+            # can run one
+            if self.provider is not None and not self.provider.is_alive(): return self.__stop(clean=False)
+            if self.provider is not None: held = bool(cache.client.eval(RENEW, 1, self.LEASE, self.id, ms))
+            else: held = bool(cache.client.set(self.LEASE, self.id, nx=True, px=ms))
+
+            if not held: return self.__stop(clean=False)
+            if self.provider is None:
+                self.provider = self.__factory()
+                self.provider.start()
+
+    def stop(self):
+        with self.__lock: self.__stop(clean=True)
+
+    # Redis is unreachable, so the lease is left to expire, but only once the
+    # provider has stopped; one still blocked on Redis is fenced out anyway
+    def abandon(self):
+        with self.__lock: self.__join()
+
+    def run(self):
+        while True:
+            try: self.poll()
+            except Exception: self.abandon()
+            time.sleep(self.__interval)
\ No newline at end of file
@@ -0,0 +1,95 @@
+import bisect, os, threading
+from array import array
+
+
+# The most recent ticks of one stock in fixed, preallocated columns: `count`
+# ticks have been written in total and the oldest kept one sits at
+# `count % capacity` once the ring has wrapped.
+class TickRing:
+    BYTES = 24
+
+    capacity: int
+    count: int
+    times: array
+    prices: array
+    volumes: array
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.count = 0
+        self.times = array('q', bytes(8 * capacity))
+        self.prices = array('d', bytes(8 * capacity))
+        self.volumes = array('q', bytes(8 * capacity))
+
+    def __len__(self): return min(self.count, self.capacity)
+
+    def __slot(self, i: int) -> int:
+        return (self.count - len(self) + i) % self.capacity
+
+    def __getitem__(self, i: int) -> int: return self.times[self.__slot(i)]
+
+    def append(self, time: int, price: float, volume: int):
+        # a tick older than the newest one would break the ordering that
+        # range queries bisect on
+        if len(self) and time < self[len(self) - 1]: return
+        slot = self.count % self.capacity
+        self.times[slot], self.prices[slot], self.volumes[slot] = time, price, volume
+        self.count += 1
+
+    def range(self, start: int | None, end: int | None, limit: int) -> dict[str, list]:
+        lo = 0 if start is None else bisect.bisect_left(self, start)
+        hi = len(self) if end is None else bisect.bisect_left(self, end)
+        lo = max(lo, hi - limit)
+
+        slots = [self.__slot(i) for i in range(lo, hi)]
+        return {
+            "time": [self.times[slot] for slot in slots],
+            "price": [self.prices[slot] for slot in slots],
+            "volume": [self.volumes[slot] for slot in slots]
+        }
+
+    def resized(self, capacity: int) -> 'TickRing':
+        ring = TickRing(capacity)
+        for i in range(max(len(self) - capacity, 0), len(self)):
+            slot = self.__slot(i)
+            ring.append(self.times[slot], self.prices[slot], self.volumes[slot])
+        return ring
+
+
+# Intraday ticks of every stock seen on the feed, kept per worker within
+# TICK_HISTORY_BYTES: the cap is split evenly between the stocks, and the
+# rings are shrunk to their new share whenever a stock is added.
+class TickHistory:
+    __rings: dict[str, TickRing]
+    __limit: int
+    __lock: threading.Lock
+
+    def __init__(self, limit: int | None = None):
+        self.__rings = {}
+        self.__limit = limit or int(os.environ.get('TICK_HISTORY_BYTES', 8 * 1024 * 1024))
+        self.__lock = threading.Lock()
+
+    def __len__(self): return len(self.__rings)
+
+    @property
+    def nbytes(self) -> int: return sum([ring.capacity * TickRing.BYTES for ring in self.__rings.values()])
+
+    def append(self, time: int, updates: dict[str, dict]):
+        with self.__lock:
+            if any([stock not in self.__rings for stock in updates]):
+                stocks = set(self.__rings) | set(updates)
+                capacity = max(self.__limit // (TickRing.BYTES * len(stocks)), 1)
+                self.__rings = dict([
+                    (stock, self.__rings[stock].resized(capacity) if stock in self.__rings else TickRing(capacity))
+                    for stock in stocks
+                ])
+
+            for stock, entry in updates.items():
+                self.__rings[stock].append(time, entry['close'], entry.get('volume', 0))
+
+    def range(self, stocks: list[str], start: int | None, end: int | None, limit: int) -> dict[str, dict]:
+        with self.__lock:
+            return dict([
+                (stock, self.__rings[stock].range(start, end, limit))
+                for stock in (stocks or list(self.__rings)) if stock in self.__rings
+            ])
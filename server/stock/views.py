@@ -1,172 +1,358 @@
 import sqlmodel as sql
 from os import environ
-from fastapi import APIRouter, HTTPException, status, Depends, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect
 
-import uuid
+import uuid, json, asyncio, time
+from concurrent.futures import Future
+from typing import Any, Coroutine
+import numpy as np
 from . import models, forms
-from user import models as user_models
-from .stock import StockProvider, Event
-from . import logic, patterns
+from user import models as user_models, portfolio
+from .stock import StockProvider, Elector, Event, PricePath, compile_paths
+from .engine import Exchange, Unavailable
+from .ledger import ShardedLedger, Leg, Batch
+from .flow import OrderFlow
+from . import patterns, history, live
+from .ticks import TickHistory
 import middleware
 
-from data.db import get_session
-from data.socket_pool import SocketPool
+from data.db import get_session, get_async_session, AsyncSession
+from data.socket_pool import SocketPool, FeedPool
 from data.cache import Cache
+from data.leaderboard import Leaderboard
+from data.bus import Bus
+from data import metrics
 
 
 router = APIRouter()
-POOL = SocketPool()
-PROVIDER = StockProvider(2, 10, POOL)
+BUS = Bus()
+POOL = FeedPool()
+FLOW = OrderFlow()
+LEADERBOARD = Leaderboard(SocketPool())
+EXCHANGE = Exchange(BUS, ShardedLedger(FLOW, LEADERBOARD))
+SNAPSHOT = history.Snapshot()
+PRICES = portfolio.Prices()
+TICKS = TickHistory()
+metrics.TICK_HISTORY_BYTES.track(lambda: TICKS.nbytes)
+UPDATE, TRIGGER = 2, 10
+ELECTOR = Elector(BUS.id, lambda: StockProvider(UPDATE, TRIGGER, BUS, FLOW, LEADERBOARD, owner=BUS.id))
 
 
-@router.get('/')
-def get_stocks(session: sql.Session = Depends(get_session)):
-    res: dict[str, dict] = {}
-    rows = session.exec(
-        sql.select(models.StockEntry, models.Stock)
-           .join(models.Stock)
-           .order_by(models.StockEntry.timestamp)# type: ignore
-    )
+def running() -> bool:
+    return bool(Cache().client.exists(Elector.RUNNING))
 
-    seen = {}
 
-    for entry, stock in rows:
-        stock_id = entry.stock_id.hex
+def on_feed(updates: dict[str, dict]):
+    for stock, entry in updates.items(): EXCHANGE.update_price(stock, entry['close'])
+    PRICES.update(updates)
+    TICKS.append(int(time.time() * 1e3), updates)
+    POOL.publish_topics(updates)
 
-        if stock_id not in res:
-            res[stock_id] = {
-                'name': stock.name,
-                'entries': [],
-            }
 
-        data = entry.to_dict()
-        if stock_id not in seen: seen[stock_id] = []
+def on_admin(message: dict):
+    provider = ELECTOR.provider
+    if provider is None: return
 
-        if data['time'] in seen[stock_id]: continue
+    if message['command'] == 'stop': ELECTOR.stop()
+    elif message['command'] == 'rates': provider.set_rates(message['rates'])
+    elif message['command'] == 'paths':
+        for stock, values in message['paths'].items(): provider.add_pattern(stock, PricePath(np.array(values)))
 
-        res[stock_id]['entries'].append(entry.to_dict())
-        seen[stock_id].append(data['time'])
-    
-    
-    if PROVIDER.started.is_set():
-        cache = Cache()
-        for stock_id in res.keys():
-            entry = models.StockEntry.from_json(uuid.UUID(stock_id), cache.get(stock_id))
-            res[stock_id]['entries'].append(entry.to_dict())
+
+BUS.subscribe('feed', on_feed)
+BUS.subscribe('leaderboard', LEADERBOARD.pool.publish)
+BUS.subscribe('admin', on_admin)
+BUS.start()
+EXCHANGE.start()
+ELECTOR.start()
+
+metrics.SOCKETS.track(lambda: len(POOL), pool='market')
+metrics.SOCKETS.track(lambda: len(LEADERBOARD.pool), pool='leaderboard')
+
+
+def snapshot_response(request: Request, session: sql.Session) -> Response:
+    cache = Cache()
+    stocks = SNAPSHOT.stocks()
+    pipe = cache.client.pipeline(transaction=False)
+    pipe.get(history.VERSION)
+    pipe.exists(Elector.RUNNING)
+    if stocks: pipe.hmget(live.CANDLES, stocks)
+    version, is_running, *candles = pipe.execute()
+    if SNAPSHOT.refresh(session, version) and SNAPSHOT.stocks() != stocks: # type: ignore
+        stocks = SNAPSHOT.stocks()
+        candles = [cache.client.hmget(live.CANDLES, stocks)] if stocks else []
+
+    etag, raw, compressed = SNAPSHOT.render(dict([
+        (stock, packed) for stock, packed in zip(stocks, candles[0] if candles else [])
+        if is_running and packed is not None
+    ]))
+    headers = { "ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding" }
+    if request.headers.get('if-none-match') == etag: return Response(status_code=304, headers=headers)
+
+    if 'gzip' in request.headers.get('accept-encoding', ''):
+        return Response(compressed, media_type='application/json', headers={ **headers, "Content-Encoding": "gzip" })
+    return Response(raw, media_type='application/json', headers=headers)
+
+
+@router.get('/')
+def get_stocks(
+    request: Request, stocks: list[str] = Query(default=[]), start: int | None = None, end: int | None = None,
+    resolution: str | None = None, columnar: bool = False,
+    session: sql.Session = Depends(get_session)
+):
+    # the unfiltered history every chart loads first is served from a
+    # shared, pre-compressed snapshot
+    if not stocks and start is None and end is None and resolution is None and not columnar:
+        return snapshot_response(request, session)
+
+    if resolution is not None and resolution not in history.RESOLUTIONS:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Unknown resolution"})
+    step = history.RESOLUTIONS.get(resolution) # type: ignore
+
+    try: uids = [uuid.UUID(stock) for stock in stocks]
+    except ValueError: raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Invalid stock ID"})
+
+    # every requested (or known) stock is answered, so a window past the
+    # last closed candle still gets the live one
+    known = sql.select(models.Stock)
+    if uids: known = known.where(models.Stock.uid.in_(uids)) # type: ignore
+    res: dict[str, dict] = dict([
+        (stock.uid.hex, { 'name': stock.name, 'entries': [] }) for stock in session.exec(known)
+    ])
+
+    query = sql.select(models.StockEntry)
+    if uids: query = query.where(models.StockEntry.stock_id.in_(uids)) # type: ignore
+    if start is not None: query = query.where(models.StockEntry.timestamp >= history.to_datetime(start))
+    if end is not None: query = query.where(models.StockEntry.timestamp < history.to_datetime(end))
+
+    for entry in session.exec(query.order_by(models.StockEntry.timestamp)): # type: ignore
+        history.append(res[entry.stock_id.hex]['entries'], entry.to_dict(), step)
+
+    if running():
+        for stock_id, candle in zip(res.keys(), live.candles(Cache(), list(res.keys()))):
+            if candle is None: continue
+            entry = candle.to_dict()
+            if end is None or entry['time'] < end:
+                history.append(res[stock_id]['entries'], entry, step)
         
+    if columnar:
+        for data in res.values(): data['entries'] = history.to_columnar(data['entries'])
 
     return res
 
 
+# Every tick of the recent past, held in memory by each worker: times are
+# when the tick reached this worker, in ms, and volume is the net units
+# traded since the stock's previous tick. Only the newest `limit` ticks in
+# [start, end) are returned.
+@router.get('/ticks')
+def get_ticks(
+    stocks: list[str] = Query(default=[]), start: int | None = None, end: int | None = None,
+    limit: int = Query(default=1000, ge=1, le=10000)
+):
+    return TICKS.range(stocks, start, end, limit)
+
+
 @router.websocket('/')
-async def connect_websocket(websocket: WebSocket):
+async def connect_websocket(
+    websocket: WebSocket, stocks: str | None = None,
+    delta: bool | None = None, encoding: str | None = None
+):
     try:
         await websocket.accept()
         POOL.add(websocket)
+        if stocks is not None or delta is not None or encoding is not None:
+            POOL.configure(
+                websocket, subscribe=stocks.split(',') if stocks else None,
+                delta=delta, binary=encoding == 'binary'
+            )
+
         while True:
-            await websocket.receive_text()
+            try: data = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError: continue
+            if not isinstance(data, dict): continue
+
+            POOL.configure(
+                websocket, subscribe=data.get('subscribe'), unsubscribe=data.get('unsubscribe'),
+                delta=data.get('delta'), binary=None if 'encoding' not in data else data['encoding'] == 'binary'
+            )
 
     except WebSocketDisconnect:
         POOL.remove(websocket)
 
 
+# Orders and settlements run on whichever worker owns the exchange, which
+# may be this one or another reached over the bus.
+async def exchange(call: Coroutine[Any, Any, Future]):
+    try: return await asyncio.wait_for(asyncio.wrap_future(await call), Exchange.TIMEOUT)
+    except (Unavailable, asyncio.TimeoutError):
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, detail={"message": "Exchange unavailable"})
+
+
 @router.post('/transact/{stock_id}')
-def transact(
-    stock_id: str, data: forms.TransactForm, session: sql.Session = Depends(get_session),
+async def transact(
+    stock_id: str, data: forms.TransactForm, session: AsyncSession = Depends(get_async_session),
     user: user_models.User = Depends(middleware.get_user)
 ):
     if not user.verified:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail={"message": "Account not verified"})
     
-    stock = session.exec(sql.select(models.Stock).where(models.Stock.uid == uuid.UUID(stock_id))).one_or_none()
+    stock = (await session.exec(sql.select(models.Stock).where(models.Stock.uid == uuid.UUID(stock_id)))).one_or_none()
     if stock is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail={"message": "Stock ID not found"})
     
-    holding = session.exec(
-        sql.select(user_models.Holding)
-        .where(user_models.Holding.user == user.uid, user_models.Holding.stock == stock.uid)
-    ).one_or_none()
-
-    
     if data.units == 0:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Units cannot be zero"})
+    if data.price is not None and data.price <= 0:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Limit price should be positive"})
     
-    res: dict[str, bool | str] = {}
-    if data.units < 0: res = logic.sell_stock(user, stock, abs(data.units), session, holding)
-    else: res = logic.buy_stock(user, stock, data.units, session, holding)
+    res = await exchange(EXCHANGE.submit(user.uid, stock.uid, data.units, data.price))
+    results, order = res['results'], res['order']
+    filled = [res for res in results if res['valid']]
+
+    if results and not filled:
+        raise HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail=results[-1])
+    if not results:
+        return { 
+            "valid": True, "message": "Order placed", 
+            "balance": user.balance, "order": order
+        }
+
+    return { **filled[-1], "order": order }
+
+
+# Market orders across many stocks in one request, settled by the user's
+# ledger shard in a single commit at the current quotes. Batches do not
+# match against resting limit orders. Atomic batches are applied only if
+# every order can be; otherwise each order stands on its own.
+@router.post('/transact')
+async def transact_batch(data: forms.BatchForm, user: user_models.User = Depends(middleware.get_user)):
+    if not user.verified:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, detail={"message": "Account not verified"})
+
+    prices = await PRICES.get_many([order.stock.hex for order in data.orders])
+    results: list[dict | None] = [
+        { "valid": False, "message": "Stock ID not found" } if np.isnan(price) else
+        { "valid": False, "message": "Units cannot be zero" } if order.units == 0 else None
+        for order, price in zip(data.orders, prices)
+    ]
+    if data.atomic and any(results):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={ "message": "Invalid orders", "results": results })
+
+    pending = [i for i, res in enumerate(results) if res is None]
+    legs = [Leg(user.uid, data.orders[i].stock, data.orders[i].units, float(prices[i])) for i in pending]
+    if legs:
+        for i, res in zip(pending, await exchange(EXCHANGE.settle(Batch(legs, data.atomic)))):
+            results[i] = { **res, "price": float(prices[i]) }
+
+    filled = [res for res in results if res['valid']] # type: ignore
+    if data.atomic and not filled:
+        raise HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail={ "message": "Batch rejected", "results": results })
+
+    return {
+        "valid": bool(filled), "balance": filled[-1]['balance'] if filled else user.balance,
+        "results": results
+    }
 
-    if not res['valid']:
-        raise HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail=res)
+
+@router.get('/orders')
+async def get_orders(user: user_models.User = Depends(middleware.get_user)):
+    return { "orders": await exchange(EXCHANGE.orders(user.uid)) }
+
+
+@router.delete('/orders/{order_id}')
+async def cancel_order(order_id: str, user: user_models.User = Depends(middleware.get_user)):
+    try: uid = uuid.UUID(order_id)
+    except ValueError: raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Invalid order ID"})
+
+    order = await exchange(EXCHANGE.cancel(uid, user.uid))
+    if order is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail={"message": "Open order not found"})
     
-    return res
+    return { "message": "Order cancelled", "order": order }
 
 
 @router.post('/')
 def start_stock(_: None = Depends(middleware.check_admin)):
-    global PROVIDER
-    if PROVIDER.started.is_set(): return HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail='Stock provider is already initialized')
+    if not Cache().client.set(Elector.RUNNING, 1, nx=True):
+        return HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail='Stock provider is already initialized')
     
-    PROVIDER = StockProvider(2, 10, POOL)
-    PROVIDER.start()
+    ELECTOR.poll()
     return {"message": "Stock provider initialized"}
 
 
 @router.delete('/')
 def stop_stock(_: None = Depends(middleware.check_admin)):
-    if not PROVIDER.started.is_set(): return HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail={"message": "Stock provider is not running!"})
+    if not running(): return HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail={"message": "Stock provider is not running!"})
 
-    PROVIDER.started.clear()
-    PROVIDER.join()
+    Cache().client.delete(Elector.RUNNING)
+    BUS.publish('admin', {"command": "stop"})
     return {"message": "Stock provider stopped"}
 
 @router.post('/events')
 def trigger_event(data: forms.StockEventForm, _: None = Depends(middleware.check_admin)):
-    if not PROVIDER.started.is_set(): raise HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail={"message": "Stock provider is not running!"})
-    for event in data.events:
-        PROVIDER.add_pattern(event['id'], [
-            Event(
-                data_from=models.StockEntry.from_json(
-                    uuid.UUID(event['id']), 
-                    Cache().get(event['id'])
-                ).close, 
-                data_to=event['to'],
-                num_candles=event['duration']
-            )
-        ])
+    if not running(): raise HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail={"message": "Stock provider is not running!"})
+
+    prices = live.prices(Cache(), [event['id'] for event in data.events])
+    paths = compile_paths([
+        [Event(
+            data_from=price, # type: ignore
+            data_to=event['to'],
+            num_candles=event['duration']
+        )] for event, price in zip(data.events, prices)
+    ])
+    BUS.publish('admin', {
+        "command": "paths",
+        "paths": dict([(event['id'], path.values.tolist()) for event, path in zip(data.events, paths)])
+    })
 
     return {"message": "Events added successfully!"}
 
 @router.post('/patterns')
 def trigger_pattern(data: forms.StockEventForm, _: None = Depends(middleware.check_admin)):
-    if not PROVIDER.started.is_set(): raise HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail={"message": "Stock provider is not running!"})
-
-    functions = {
-        'bullish_flag': patterns.BULLISH_FLAG,
-        'bearish_flag': patterns.BEARISH_FLAG,
-        'bullish_pennant': patterns.BULLISH_PENNANT,
-        'bearish_pennant': patterns.BEARISH_PENNANT,
-        'double_top': patterns.DOUBLE_TOP,
-        'double_bottom': patterns.DOUBLE_BOTTOM,
-        'head_and_shoulders': patterns.HEAD_AND_SHOULDERS,
-        'inverse_head_and_shoulders': patterns.INVERSE_HEAD_AND_SHOULDERS,
-        'rising_wedge': patterns.RISING_WEDGE,
-        'falling_wedge': patterns.FALLING_WEDGE,
-        'rectangle': patterns.RECTANGLE,
-        'cup_and_handle': patterns.CUP_AND_HANDLE,
-        'inverted_cup_and_handle': patterns.INVERTED_CUP_AND_HANDLE,
-    }
+    if not running(): raise HTTPException(status.HTTP_428_PRECONDITION_REQUIRED, detail={"message": "Stock provider is not running!"})
+
+    events = [event for event in data.events if event['pattern'] in patterns.PATTERNS]
+    prices = live.prices(Cache(), [event['id'] for event in events])
+    paths = compile_paths([
+        patterns.PATTERNS[event['pattern']](price) # type: ignore
+        for event, price in zip(events, prices)
+    ])
+    BUS.publish('admin', {
+        "command": "paths",
+        "paths": dict([(event['id'], path.values.tolist()) for event, path in zip(events, paths)])
+    })
+
+    return {"message": "Patterns added successfully!"}
+
+
+@router.put('/rates')
+def set_rates(
+    data: forms.RatesForm, _: None = Depends(middleware.check_admin),
+    session: sql.Session = Depends(get_session)
+):
+    intervals = [value for value in [data.update, data.trigger, *data.stocks.values(), *data.categories.values()] if value is not None]
+    if any([value < 0.05 for value in intervals]):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Intervals should be at least 0.05 seconds"})
+
+    # per-stock intervals override their category's, and null removes one
+    stocks = dict(data.stocks)
+    if data.categories:
+        for stock in session.exec(sql.select(models.Stock).where(models.Stock.category.in_(list(data.categories)))): # type: ignore
+            stocks.setdefault(stock.uid.hex, data.categories[stock.category])
 
     cache = Cache()
-    for event in data.events:
-        value = models.StockEntry.from_json(
-            uuid.UUID(event['id']), 
-            cache.get(event['id'])
-        ).close
-
-        if event['pattern'] not in functions: continue
-        PROVIDER.add_pattern(
-            event['id'], 
-            functions[event['pattern']](value)
-        )
-
-    return {"message": "Patterns added successfully!"}
\ No newline at end of file
+    rates = json.loads(cache.client.get(StockProvider.RATES) or '{}') # type: ignore
+    if data.update is not None: rates['update'] = data.update
+    if data.trigger is not None: rates['trigger'] = data.trigger
+    overrides = { **rates.get('stocks', {}), **stocks }
+    rates['stocks'] = dict([(stock, value) for stock, value in overrides.items() if value is not None])
+
+    # candles close every `trigger` seconds, so no stock may tick slower
+    trigger = rates.get('trigger', TRIGGER)
+    if any([value > trigger for value in [rates.get('update', UPDATE), *rates['stocks'].values()]]):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Intervals should not exceed the trigger interval"})
+
+    cache.client.set(StockProvider.RATES, json.dumps(rates))
+    BUS.publish('admin', {"command": "rates", "rates": rates})
+    return {"message": "Rates updated", "rates": rates}
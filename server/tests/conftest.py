@@ -0,0 +1,21 @@
+import os, tempfile
+import pytest
+
+# the modules under test read their settings on import
+os.environ.setdefault('DB_URL', f'sqlite:///{tempfile.mkdtemp(prefix="sms-test-")}/test.sqlite')
+os.environ.setdefault('SECRET', 'test')
+os.environ.setdefault('LEDGER_SHARDS', '1')
+
+
+# Every test gets an empty in-process Redis, with Lua for the scripts
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    import fakeredis, redis, redis.asyncio
+    from data import cache
+
+    server = fakeredis.FakeServer()
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=server)
+    async_pool = redis.asyncio.ConnectionPool(connection_class=fakeredis.FakeAsyncRedisConnection, server=server)
+    monkeypatch.setattr(cache, 'get_pool', lambda: pool)
+    monkeypatch.setattr(cache, 'get_async_pool', lambda: async_pool)
+    return cache.Cache()
@@ -0,0 +1,98 @@
+import pytest, uuid
+from stock.engine import Order, OrderBook
+
+STOCK = uuid.uuid4()
+
+
+def order(units: int, price: float | None = None, user: uuid.UUID | None = None) -> Order:
+    return Order(user or uuid.uuid4(), STOCK, units, price)
+
+
+def test_match_prefers_best_price_then_time():
+    book = OrderBook()
+    early, late, best = order(-5, 11), order(-5, 11), order(-5, 10)
+    for maker in (late, early, best): book.rest(maker)
+
+    taker = order(12, 11)
+    fills = []
+    while (match := book.match(taker)) is not None:
+        maker, units = match
+        taker.fill(units)
+        maker.fill(units)
+        fills.append((maker, units))
+
+    assert fills == [(best, 5), (early, 5), (late, 2)]
+    assert not taker.is_open and late.remaining == 3
+    assert book.orders() == [late]
+
+
+def test_match_does_not_fill():
+    book = OrderBook()
+    maker = order(-5, 10)
+    book.rest(maker)
+    taker = order(3)
+
+    assert book.match(taker) == (maker, 3)
+    assert book.match(taker) == (maker, 3)
+    assert taker.remaining == 3 and maker.remaining == 5
+
+
+def test_match_stops_at_limit():
+    book = OrderBook()
+    book.rest(order(-5, 10))
+    assert book.match(order(5, 9)) is None
+    assert book.match(order(-5, 9)) is None
+
+
+def test_match_cancels_own_orders():
+    book = OrderBook()
+    user = uuid.uuid4()
+    own, other = order(-5, 10, user), order(-5, 11)
+    book.rest(own)
+    book.rest(other)
+
+    cancelled = []
+    assert book.match(order(5, 11, user), cancelled=cancelled.append) == (other, 5)
+    assert own.cancelled and own.reason == "Self-trade"
+    assert cancelled == [own]
+
+
+def test_match_leaves_makers_worse_than_quote():
+    book = OrderBook()
+    ask, bid = order(-5, 10), order(5, 8)
+    book.rest(ask)
+    book.rest(bid)
+
+    assert book.match(order(5), quote=9.5) is None
+    assert book.match(order(5), quote=10) == (ask, 5)
+    assert book.match(order(-5), quote=8.5) is None
+    assert book.match(order(-5), quote=8) == (bid, 5)
+
+
+def test_cancelled_orders_are_skipped():
+    book = OrderBook()
+    first, second = order(-5, 10), order(-5, 10)
+    book.rest(first)
+    book.rest(second)
+
+    first.cancel()
+    assert not first.is_open and first.reason is None
+    assert book.match(order(5)) == (second, 5)
+    assert book.orders() == [second]
+
+    second.cancel("Insufficient balance")
+    assert book.match(order(5)) is None
+    assert second.to_dict()['reason'] == "Insufficient balance"
+
+
+def test_crossed_by_in_time_order():
+    book = OrderBook()
+    bid, ask, far = order(5, 10), order(-5, 9), order(5, 8)
+    for resting in (bid, ask, far): book.rest(resting)
+
+    assert book.crossed_by(9.5) == [bid, ask]
+    assert book.orders() == [far]
+
+
+def test_market_orders_do_not_rest():
+    with pytest.raises(ValueError): OrderBook().rest(order(5))
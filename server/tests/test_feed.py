@@ -0,0 +1,24 @@
+import asyncio, json
+from data.socket_pool import FeedPool
+
+
+class Socket:
+    def __init__(self): self.frames = []
+    async def send_text(self, frame: str): self.frames.append(json.loads(frame))
+
+
+def test_snapshots_carry_the_last_values_of_subscribed_topics():
+    async def run():
+        pool, socket = FeedPool(), Socket()
+        pool.add(socket)
+        pool.publish_topics({'a': {'close': 1}, 'b': {'close': 2}, 'c': {'close': 3}})
+        pool.configure(socket, subscribe=['a', 'b'], delta=True)
+        pool.publish_topics({'a': {'close': 4}})
+        pool.publish_topics({'a': {'close': 4}, 'b': {'close': 5}})
+        await asyncio.sleep(0.01)
+        return socket.frames
+
+    legacy, snapshot, delta = asyncio.run(run())
+    assert legacy == {'a': {'close': 1}, 'b': {'close': 2}, 'c': {'close': 3}}
+    assert snapshot == {'type': 'snapshot', 'data': {'a': {'close': 4}, 'b': {'close': 2}}}
+    assert delta == {'type': 'delta', 'data': {'b': {'close': 5}}}
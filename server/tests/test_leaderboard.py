@@ -0,0 +1,62 @@
+import uuid
+import sqlmodel as sql
+
+from data.db import engine
+from data.leaderboard import Leaderboard
+from data.socket_pool import SocketPool
+from user.models import User
+
+
+def scores(cache) -> dict[str, float]:
+    return dict([(name.decode(), score) for name, score in cache.client.zrange(Leaderboard.RANK, 0, -1, withscores=True)])
+
+
+def test_settle_moves_cash_and_position(cache):
+    board = Leaderboard(SocketPool())
+    cache.client.zadd(Leaderboard.RANK, {'a': 100})
+    cache.client.hset(Leaderboard.PRICE, 's', 10)
+
+    board.settle('a', -30, 's', 3)
+    board.settle('a', 5, 's', -1)
+
+    assert scores(cache) == {'a': 95}
+    assert cache.client.hget(Leaderboard.POSITIONS + 's', 'a') == b'2'
+
+
+def test_settle_waits_for_a_rebuild(cache):
+    Leaderboard(SocketPool()).settle('a', -30, 's', 3)
+    assert not cache.client.exists(Leaderboard.RANK, Leaderboard.POSITIONS + 's')
+
+
+def test_update_prices_revalues_holders(cache):
+    board = Leaderboard(SocketPool())
+    cache.client.zadd(Leaderboard.RANK, {'a': 100, 'b': 100, 'c': 100})
+    cache.client.hset(Leaderboard.PRICE, mapping={'s': 10, 't': 5})
+    cache.client.hset(Leaderboard.POSITIONS + 's', mapping={'a': 2, 'b': -1})
+
+    board.update_prices({'s': 12, 't': 5, 'u': 1})
+
+    assert scores(cache) == {'a': 104, 'b': 98, 'c': 100}
+    assert cache.client.hgetall(Leaderboard.PRICE) == {b's': b'12', b't': b'5', b'u': b'1'}
+
+
+def test_update_prices_waits_for_a_rebuild(cache):
+    Leaderboard(SocketPool()).update_prices({'s': 12})
+    assert not cache.client.exists(Leaderboard.PRICE)
+
+
+def test_rebuild_keeps_existing_scores(cache):
+    sql.SQLModel.metadata.create_all(engine)
+    with sql.Session(engine) as session:
+        user = User(uuid.uuid4().hex, 'test', balance=100)
+        user.verified = True
+        session.add(user)
+        session.commit()
+
+        board = Leaderboard(SocketPool())
+        board.rebuild(session)
+        assert scores(cache)[user.username] == 100
+
+        board.settle(user.username, 25, 's', 0)
+        board.rebuild(session)
+        assert scores(cache)[user.username] == 125
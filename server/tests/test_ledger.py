@@ -0,0 +1,98 @@
+import uuid
+import pytest
+import sqlmodel as sql
+
+from data.db import engine
+from data.leaderboard import Leaderboard
+from data.socket_pool import SocketPool
+from stock.flow import OrderFlow
+from stock.ledger import Ledger, ShardedLedger, Leg, Batch, dump_flush
+from stock.models import Stock, LedgerFlush
+from user.models import User, Holding, Transaction
+
+
+@pytest.fixture
+def accounts():
+    sql.SQLModel.metadata.create_all(engine)
+    with sql.Session(engine) as session:
+        user, stock = User(uuid.uuid4().hex, 'test', balance=100), Stock(name='Stock', category='Test')
+        session.add_all([user, stock])
+        session.commit()
+        return user.uid, stock.uid
+
+
+def balance(user: uuid.UUID) -> float:
+    with sql.Session(engine) as session: return session.get(User, user).balance # type: ignore
+
+
+def journal(id: str, shard: int) -> str: return f'{Ledger.JOURNAL}{id}:{shard}'
+
+
+def test_recover_skips_committed_flushes_with_rejected_legs(cache, accounts):
+    user, stock = accounts
+    # the flush committed while the leg could not be paid for, and the user
+    # has since been credited enough for a replay to succeed
+    flush = uuid.uuid4()
+    with sql.Session(engine) as session:
+        session.add(LedgerFlush(uid=flush))
+        session.get(User, user).balance = 1000 # type: ignore
+        session.commit()
+    cache.client.rpush(journal('gone', 0), dump_flush(flush, [Leg(user, stock, 1, 500, rate=1)]))
+
+    ShardedLedger(OrderFlow(), Leaderboard(SocketPool())).recover()
+
+    assert balance(user) == 1000
+    assert not list(cache.client.scan_iter(match=Ledger.JOURNAL + '*'))
+    with sql.Session(engine) as session:
+        assert not session.exec(sql.select(Transaction).where(Transaction.user == user)).all()
+
+
+def test_recover_replays_lost_flushes_once(cache, accounts):
+    user, stock = accounts
+    # left by an owner that ran more shards than this one
+    lost = uuid.uuid4()
+    cache.client.rpush(journal('gone', 7), dump_flush(lost, [
+        Leg(user, stock, 1, 30, rate=1), Batch([Leg(user, stock, 1, 30, rate=1), Leg(user, stock, 1, 500, rate=1)], atomic=True)
+    ]))
+
+    ledger = ShardedLedger(OrderFlow(), Leaderboard(SocketPool()))
+    ledger.recover()
+    # a second owner finding the journal again must not apply it twice
+    cache.client.rpush(journal('gone', 7), dump_flush(lost, [Leg(user, stock, 1, 30, rate=1)]))
+    ledger.recover()
+
+    assert balance(user) == 70
+    with sql.Session(engine) as session:
+        assert session.get(LedgerFlush, lost) is not None
+        assert session.exec(sql.select(Holding).where(Holding.user == user)).one().quantity == 1
+
+
+def test_recover_leaves_own_journals(cache, accounts):
+    user, stock = accounts
+    ledger = ShardedLedger(OrderFlow(), Leaderboard(SocketPool()))
+    own = journal(ledger.id, 0)
+    cache.client.rpush(own, dump_flush(uuid.uuid4(), [Leg(user, stock, 1, 30, rate=1)]))
+
+    ledger.recover()
+
+    assert balance(user) == 100
+    assert cache.client.exists(own)
+
+
+def test_flush_outlives_cache_errors(cache, accounts, monkeypatch):
+    user, stock = accounts
+    ledger = ShardedLedger(OrderFlow(), Leaderboard(SocketPool()))
+    ledger.start()
+
+    # the commit stands even though the caches could not follow it
+    def down(*_): raise ConnectionError('cache down')
+    monkeypatch.setattr('user.cache.invalidate', down)
+    assert ledger.settle(Leg(user, stock, 1, 30, rate=1)).result(timeout=5)['valid']
+    assert balance(user) == 70
+
+    # a journal that cannot be written fails the batch, not the shard
+    with monkeypatch.context() as patch:
+        patch.setattr(type(cache.client), 'pipeline', down)
+        with pytest.raises(ConnectionError): ledger.settle(Leg(user, stock, 1, 30, rate=1)).result(timeout=5)
+    assert ledger.settle(Leg(user, stock, -1, 30, rate=1)).result(timeout=5)['valid']
+    assert balance(user) == 100
@@ -0,0 +1,48 @@
+import uuid, pytz
+from datetime import datetime
+
+from stock import live
+from stock.live import LiveCandle
+
+
+def candle() -> LiveCandle:
+    res = LiveCandle(uuid.uuid4(), 100.25, datetime(2024, 5, 1, 9, 15, 30, 123000, tzinfo=pytz.utc))
+    for value in (101.5, 99.75, 100.5): res.set_value(value)
+    return res
+
+
+def test_pack_round_trip():
+    original = candle()
+    data = original.pack()
+    assert len(data) == live.FORMAT.size
+
+    restored = LiveCandle.unpack(original.stock_id, data)
+    assert restored.stock_id == original.stock_id
+    assert restored.to_dict() == original.to_dict() == {
+        "open": 100.25, "close": 100.5, "low": 99.75, "high": 101.5, "time": original.time
+    }
+    # timestamps come back at millisecond precision, in the market's zone
+    assert restored.timestamp == original.timestamp
+    assert restored.timestamp.tzinfo is not None
+
+    entry = restored.to_entry()
+    assert (entry.stock_id, entry.open, entry.close, entry.timestamp) == (original.stock_id, 100.25, 100.5, original.timestamp)
+
+
+def test_store_and_read_back(cache):
+    first, second = candle(), candle()
+    second.set_value(120)
+    live.store(cache, [first, second])
+
+    missing = uuid.uuid4().hex
+    stocks = [first.stock_id.hex, missing, second.stock_id.hex]
+    restored = live.candles(cache, stocks)
+    assert restored[1] is None
+    assert [candle.to_dict() for candle in restored if candle is not None] == [first.to_dict(), second.to_dict()] # type: ignore
+    assert live.prices(cache, stocks) == [100.5, None, 120]
+
+
+def test_store_nothing(cache):
+    live.store(cache, [])
+    assert live.candles(cache, []) == [] and live.prices(cache, []) == []
+    assert not cache.client.exists(live.CANDLES, live.PRICES)
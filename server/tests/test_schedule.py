@@ -0,0 +1,48 @@
+from stock.stock import Schedule
+
+
+def test_close_advances_whole_periods():
+    schedule = Schedule(['a'], 2, 10, 0)
+
+    assert schedule.due(35) == (True, [], set(), 25)
+    assert schedule.next_close == 40
+    assert schedule.next_tick == {'a': 32}
+    assert schedule.elapsed(35) == 5
+
+
+def test_missed_ticks_are_dropped():
+    schedule = Schedule(['a'], 2, 10, 0)
+    schedule.due(0)
+
+    assert schedule.due(7) == (False, ['a'], set(), 5)
+    assert schedule.next_tick == {'a': 8}
+    assert schedule.due(7.5) == (False, [], set(), 0)
+
+
+def test_last_tick_before_close():
+    schedule = Schedule(['a', 'b'], 2, 10, 0, rates={'b': 3})
+
+    assert schedule.due(8) == (False, ['a', 'b'], {'a'}, 8)
+    assert schedule.next_tick == {'a': 10, 'b': 9}
+    assert schedule.next_deadline() == 9
+    assert schedule.due(9) == (False, ['b'], {'b'}, 0)
+    assert schedule.next_deadline() == 10
+
+
+def test_trigger_change_moves_the_open_candle():
+    schedule = Schedule(['a'], 2, 10, 0)
+    schedule.due(0)
+
+    # the candle keeps its start and closes at the new length
+    schedule.set_rates(4, trigger=20)
+    assert (schedule.next_close, schedule.elapsed(4)) == (20, 4)
+
+    schedule.set_rates(4.5, trigger=5, update=0.5)
+    assert schedule.next_close == 5
+    assert schedule.due(4.5) == (False, ['a'], {'a'}, 2.5)
+    assert schedule.next_tick == {'a': 5}
+
+    # a faster rate brings the next tick forward
+    schedule.set_rates(4.5, update=0.25)
+    assert schedule.next_tick == {'a': 4.75}
+    assert schedule.due(5)[0]
@@ -0,0 +1,58 @@
+from stock.ticks import TickRing, TickHistory
+
+
+def ring(capacity: int, times: list[int]) -> TickRing:
+    res = TickRing(capacity)
+    for time in times: res.append(time, time / 10, time * 2)
+    return res
+
+
+def test_range_before_wrapping():
+    ticks = ring(8, [10, 20, 30, 40])
+    assert ticks.range(None, None, 100) == { "time": [10, 20, 30, 40], "price": [1, 2, 3, 4], "volume": [20, 40, 60, 80] }
+    # start is inclusive and end exclusive
+    assert ticks.range(20, 40, 100)['time'] == [20, 30]
+    assert ticks.range(15, None, 100)['time'] == [20, 30, 40]
+    assert ticks.range(50, None, 100)['time'] == []
+
+
+def test_range_keeps_the_newest_within_limit():
+    assert ring(8, [10, 20, 30, 40]).range(None, None, 2)['time'] == [30, 40]
+    assert ring(8, [10, 20, 30, 40]).range(10, 40, 2)['time'] == [20, 30]
+
+
+def test_range_after_wrapping():
+    ticks = ring(4, [10, 20, 30, 40, 50, 60])
+    assert len(ticks) == 4 and ticks.count == 6
+    assert ticks.range(None, None, 100)['time'] == [30, 40, 50, 60]
+    assert ticks.range(35, 60, 100) == { "time": [40, 50], "price": [4, 5], "volume": [80, 100] }
+
+
+def test_out_of_order_ticks_are_dropped():
+    ticks = ring(4, [10, 30, 20, 30])
+    assert ticks.range(None, None, 100)['time'] == [10, 30, 30]
+
+
+def test_resized_keeps_the_newest():
+    ticks = ring(4, [10, 20, 30, 40, 50, 60])
+    smaller = ticks.resized(2)
+    assert smaller.capacity == 2 and smaller.range(None, None, 100)['time'] == [50, 60]
+
+    larger = ticks.resized(8)
+    assert larger.range(None, None, 100)['time'] == [30, 40, 50, 60]
+    larger.append(70, 7, 140)
+    assert larger.range(None, None, 100)['time'] == [30, 40, 50, 60, 70]
+
+
+def test_history_splits_its_limit_between_stocks():
+    history = TickHistory(limit=TickRing.BYTES * 8)
+    for time in range(10): history.append(time, { "a": { "close": time } })
+    assert history.nbytes == TickRing.BYTES * 8
+    assert history.range([], None, None, 100)['a']['time'] == list(range(2, 10))
+
+    history.append(10, { "a": { "close": 10 }, "b": { "close": 1, "volume": 3 } })
+    assert history.nbytes == TickRing.BYTES * 8
+    res = history.range([], None, None, 100)
+    assert res['a']['time'] == [7, 8, 9, 10]
+    assert res['b'] == { "time": [10], "price": [1], "volume": [3] }
+    assert list(history.range(['b', 'c'], None, None, 100)) == ['b']
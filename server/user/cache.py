@@ -0,0 +1,126 @@
+import json, threading, time, uuid
+from collections import OrderedDict
+from sqlalchemy.orm import configure_mappers
+
+from data.cache import Cache, AsyncCache
+from data.bus import Bus
+from .models import User
+
+
+class LRU:
+    __data: OrderedDict
+    __size: int
+    __ttl: float
+    __lock: threading.Lock
+
+    def __init__(self, size: int, ttl: float):
+        self.__data = OrderedDict()
+        self.__size = size
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is None: return None
+            if item[0] < time.monotonic():
+                del self.__data[key]
+                return None
+
+            self.__data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__data[key] = (time.monotonic() + self.__ttl, value)
+            self.__data.move_to_end(key)
+            if len(self.__data) > self.__size: self.__data.popitem(last=False)
+
+    def pop(self, key):
+        with self.__lock: self.__data.pop(key, None)
+
+
+# Every invalidation bumps the user's version, and a row read from the
+# database is only cached if the version is still the one seen before the
+# read, so a slow reader can never cache a row older than a settlement that
+# finished meanwhile. Invalidations are also broadcast, so that every worker
+# drops its local copy instead of serving it until it expires.
+TTL = 30
+TOKENS = LRU(10000, 300)
+USERS = LRU(10000, 2)
+CHANNEL = 'users'
+# the number of local invalidations so far, so that a copy fetched from Redis
+# while one ran is not kept locally
+GENERATION = 0
+
+PUT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then return 0 end
+redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+def key(uid: uuid.UUID) -> str: return f'user:{uid.hex}'
+
+
+def version_key(uid: uuid.UUID) -> str: return f'user:version:{uid.hex}'
+
+
+def dump(user: User) -> str:
+    return json.dumps({
+        "uid": user.uid.hex, "username": user.username,
+        "balance": user.balance, "verified": user.verified
+    })
+
+
+def load(data: str) -> User:
+    configure_mappers()
+    fields = json.loads(data)
+    # cached users are read-only snapshots: the password hash is never cached
+    return User.model_construct(
+        uid=uuid.UUID(fields['uid']), username=fields['username'], password='',
+        balance=fields['balance'], verified=fields['verified']
+    )
+
+
+async def version(uid: uuid.UUID) -> int:
+    return int(await AsyncCache().client.get(version_key(uid)) or 0)
+
+
+async def get(uid: uuid.UUID) -> User | None:
+    user = USERS.get(uid)
+    if user is not None: return user
+
+    generation = GENERATION
+    data = await AsyncCache().client.get(key(uid))
+    if data is None: return None
+
+    user = load(data.decode())
+    if generation == GENERATION: USERS.set(uid, user)
+    return user
+
+
+async def put(user: User, version: int):
+    generation = GENERATION
+    stored = await AsyncCache().client.eval(PUT, 2, key(user.uid), version_key(user.uid), version, dump(user), TTL) # type: ignore
+    if stored and generation == GENERATION: USERS.set(user.uid, user)
+
+
+def drop(message: dict):
+    global GENERATION
+    GENERATION += 1
+    for uid in message['uids']: USERS.pop(uuid.UUID(uid))
+
+
+def invalidate(*uids: uuid.UUID):
+    if not uids: return
+    drop({"uids": [uid.hex for uid in uids]})
+
+    pipe = Cache().client.pipeline(transaction=False)
+    for uid in uids:
+        pipe.delete(key(uid))
+        # versions outlive any read of the row by far
+        pipe.incr(version_key(uid))
+        pipe.expire(version_key(uid), 10 * TTL)
+    pipe.publish(Bus.PREFIX + CHANNEL, json.dumps({"uids": [uid.hex for uid in uids]}))
+    pipe.execute()
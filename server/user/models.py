@@ -19,6 +19,19 @@ class User(BaseModel, table=True):
 
 
 class Transaction(BaseTimestampModel, table=True):
+    # history pages are range scans of these; on Postgres they also cover the
+    # listed columns so the table itself is never read
+    __table_args__ = (
+        sql.Index(
+            'ix_transaction_user_timestamp_uid', 'user', 'timestamp', 'uid',
+            postgresql_include=['stock', 'num_units', 'price']
+        ),
+        sql.Index(
+            'ix_transaction_user_stock_timestamp_uid', 'user', 'stock', 'timestamp', 'uid',
+            postgresql_include=['num_units', 'price']
+        ),
+    )
+
     num_units: int
     price: float
     stock: uuid.UUID = sql.Field(foreign_key='stock.uid', ondelete='CASCADE')
@@ -30,4 +43,5 @@ class Holding(BaseModel, table=True):
     user: uuid.UUID = sql.Field(foreign_key='user.uid', ondelete='CASCADE')
     quantity: int
     short_balance: float
-    avg_price: float
\ No newline at end of file
+    avg_price: float
+    realized: float = sql.Field(default=0, sa_column_kwargs={"server_default": "0"})
\ No newline at end of file
@@ -0,0 +1,112 @@
+import asyncio
+import numpy as np
+import sqlmodel as sql
+
+from data.db import AsyncSession
+from . import cache as user_cache
+from .cache import LRU
+from .models import User, Holding
+from stock import live, logic
+
+
+# Latest close of every stock as seen on the feed by this worker. `tick`
+# advances once per feed frame, so it doubles as the version of the prices.
+class Prices:
+    tick: int
+    values: dict[str, float]
+    __loop: asyncio.AbstractEventLoop | None
+    __event: asyncio.Event | None
+
+    def __init__(self):
+        self.tick = 0
+        self.values = {}
+        self.__loop = None
+        self.__event = None
+
+    def update(self, updates: dict[str, dict]):
+        # called from the bus thread: readers only ever see whole dicts
+        self.values = {**self.values, **dict([(stock, entry['close']) for stock, entry in updates.items()])}
+        self.tick += 1
+        if self.__loop is not None and not self.__loop.is_closed():
+            self.__loop.call_soon_threadsafe(self.__notify)
+
+    def __notify(self):
+        event, self.__event = self.__event, asyncio.Event()
+        if event is not None: event.set()
+
+    async def wait(self):
+        if self.__event is None:
+            self.__loop = asyncio.get_running_loop()
+            self.__event = asyncio.Event()
+        await self.__event.wait()
+
+    async def get_many(self, stocks: list[str]) -> np.ndarray:
+        values = self.values
+        missing = [stock for stock in stocks if stock not in values]
+        if missing:
+            fetched = await live.prices_async(missing)
+            values = {**values, **dict([(stock, price) for stock, price in zip(missing, fetched) if price is not None])}
+        return np.array([values.get(stock, np.nan) for stock in stocks], dtype=float)
+
+
+class Positions:
+    stocks: list[str]
+    quantity: np.ndarray
+    avg_price: np.ndarray
+    short_balance: np.ndarray
+    realized: np.ndarray
+
+    def __init__(self, holdings: list[Holding]):
+        self.stocks = [holding.stock.hex for holding in holdings]
+        self.quantity = np.array([holding.quantity for holding in holdings], dtype=float)
+        self.avg_price = np.array([holding.avg_price for holding in holdings], dtype=float)
+        self.short_balance = np.array([holding.short_balance for holding in holdings], dtype=float)
+        self.realized = np.array([holding.realized for holding in holdings], dtype=float)
+
+
+def value(balance: float, positions: Positions, price: np.ndarray) -> dict:
+    # stocks without a quote are marked at their average price
+    price = np.where(np.isnan(price), positions.avg_price, price)
+    market_value = positions.quantity * price
+    unrealized = positions.quantity * (price - positions.avg_price)
+    short_exposure = np.where(positions.quantity < 0, -market_value, 0)
+
+    columns = {
+        "quantity": positions.quantity.astype(int).tolist(), "avg_price": positions.avg_price.tolist(),
+        "price": price.tolist(), "market_value": market_value.tolist(), "unrealized": unrealized.tolist(),
+        "realized": positions.realized.tolist(), "short_exposure": short_exposure.tolist()
+    }
+    return {
+        "balance": balance,
+        "net_worth": balance + float(logic.position_value(positions.short_balance, positions.quantity, price).sum()),
+        "totals": {
+            "market_value": float(market_value.sum()), "unrealized": float(unrealized.sum()),
+            "realized": float(positions.realized.sum()), "short_exposure": float(short_exposure.sum())
+        },
+        "holdings": dict([
+            (stock, dict([(key, values[i]) for key, values in columns.items()]))
+            for i, stock in enumerate(positions.stocks)
+        ])
+    }
+
+
+# Valuations are shared by every request of a user within one tick. The
+# balance and holdings behind them are read together from the database, and
+# again only once a settlement bumps the user's cache version; the version is
+# read first, so a settlement racing the read only causes another reload.
+CACHE = LRU(10000, 60)
+
+
+async def get(user: User, session: AsyncSession, prices: Prices) -> dict:
+    tick, version = prices.tick, await user_cache.version(user.uid)
+    cached = CACHE.get(user.uid)
+    if cached is not None and cached[0] == (tick, version): return cached[3]
+
+    if cached is not None and cached[0][1] == version: balance, positions = cached[1], cached[2]
+    else:
+        balance = (await session.exec(sql.select(User.balance).where(User.uid == user.uid))).one()
+        positions = Positions(list(await session.exec(sql.select(Holding).where(Holding.user == user.uid))))
+
+    res = { "tick": tick, **value(balance, positions, await prices.get_many(positions.stocks)) }
+    CACHE.set(user.uid, ((tick, version), balance, positions, res))
+    return res
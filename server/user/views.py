@@ -1,13 +1,20 @@
-import os, jwt
+import os, jwt, asyncio, base64, json, uuid
+from datetime import datetime
 import sqlmodel as sql
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 
-from data.db import get_session
-from . import forms, models
+from data.db import get_session, get_async_session, AsyncSession, async_engine
+from data import metrics
+from . import forms, models, cache, portfolio
 from stock.models import Stock
+from stock.views import LEADERBOARD, PRICES, BUS
 import middleware
 
 router = APIRouter()
+SOCKETS: set[WebSocket] = set()
+BUS.subscribe(cache.CHANNEL, cache.drop)
+metrics.SOCKETS.track(lambda: len(SOCKETS), pool='portfolio')
 
 
 @router.post('/login')
@@ -41,13 +48,15 @@ def verify_user(username: str, _: None = Depends(middleware.check_admin), sessio
     
     user.verified = True
     user.save(session)
+    cache.invalidate(user.uid)
+    LEADERBOARD.add_user(user.username, user.balance)
     return { "message": "User verified successfully." }
 
 
 @router.get('/')
-def get_info(
+async def get_info(
     user: models.User = Depends(middleware.get_user),
-    session: sql.Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     return {
         "balance": user.balance,
@@ -56,29 +65,99 @@ def get_info(
                 "avg_price": holding.avg_price,
                 "quantity": holding.quantity
             }) for holding in
-            session.exec(
+            await session.exec(
                 sql.select(models.Holding)
                 .where(models.Holding.user == user.uid)
             )
         ])  
     }
 
-@router.get('/transactions')
-def get_transactions(
+@router.get('/portfolio')
+async def get_portfolio(
     user: models.User = Depends(middleware.get_user),
-    session: sql.Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
+):
+    return await portfolio.get(user, session, PRICES)
+
+
+# Pushes the portfolio again after every tick of the feed. Browsers cannot
+# set headers on websockets, so the token is passed as a query parameter.
+@router.websocket('/portfolio/')
+async def connect_portfolio(websocket: WebSocket, token: str):
+    async def stream():
+        while True:
+            async with AsyncSession(async_engine) as session:
+                try: user = await middleware.authenticate(token, session)
+                except HTTPException: return await websocket.close(code=1008)
+                res = await portfolio.get(user, session, PRICES)
+            await websocket.send_json(res)
+            await PRICES.wait()
+
+    try:
+        async with AsyncSession(async_engine) as session: await middleware.authenticate(token, session)
+    except HTTPException: return await websocket.close(code=1008)
+
+    await websocket.accept()
+    SOCKETS.add(websocket)
+    task = asyncio.create_task(stream())
+    try:
+        while True: await websocket.receive_text()
+    except WebSocketDisconnect: pass
+    finally:
+        SOCKETS.discard(websocket)
+        task.cancel()
+
+
+def encode_cursor(transaction: models.Transaction) -> str:
+    return base64.urlsafe_b64encode(f'{transaction.timestamp.isoformat()},{transaction.uid.hex}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    try:
+        timestamp, uid = base64.urlsafe_b64decode(cursor.encode()).decode().split(',')
+        return datetime.fromisoformat(timestamp), uuid.UUID(uid)
+    except ValueError:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail={"message": "Invalid cursor"})
+
+
+# Newest first. Without a cursor or limit the whole history is returned, as
+# before; otherwise one page at a time: the cursor is the (timestamp, uid) of
+# the last transaction returned, so every page is a range scan of the
+# (user, timestamp, uid) index however long the history is. Rows are
+# streamed as they are read, followed by the cursor of the next page.
+@router.get('/transactions')
+async def get_transactions(
+    cursor: str | None = None, stock: uuid.UUID | None = None,
+    limit: int | None = Query(default=None, ge=1, le=1000),
+    user: models.User = Depends(middleware.get_user)
 ):
-    res = []
-    for transaction, stock in session.exec(
-        sql.select(models.Transaction, Stock)
+    if limit is None and cursor is not None: limit = 100
+    query = (
+        sql.select(models.Transaction, Stock.name)
         .join(Stock)
         .where(models.Transaction.user == user.uid)
-        .order_by(models.Transaction.timestamp.desc()) # type: ignore
-    ):
-        res.append({
-            "stock": stock.name,
-            "units": transaction.num_units,
-            "price": transaction.price,
-        })
-    
-    return { "transactions": res }
\ No newline at end of file
+        .order_by(models.Transaction.timestamp.desc(), models.Transaction.uid.desc()) # type: ignore
+    )
+    if limit is not None: query = query.limit(limit + 1)
+    if stock is not None: query = query.where(models.Transaction.stock == stock)
+    if cursor is not None:
+        query = query.where(sql.tuple_(models.Transaction.timestamp, models.Transaction.uid) < decode_cursor(cursor))
+
+    async def stream():
+        count, last = 0, None
+        yield '{"transactions": ['
+        async with AsyncSession(async_engine) as session:
+            async for transaction, name in await session.stream(query):
+                if count == limit:
+                    yield '], "next": %s}' % json.dumps(encode_cursor(last)) # type: ignore
+                    return
+
+                yield (', ' if count else '') + json.dumps({
+                    "stock": name, "stock_id": transaction.stock.hex,
+                    "units": transaction.num_units, "price": transaction.price,
+                    "time": int(transaction.timestamp.timestamp() * 1e3)
+                })
+                count, last = count + 1, transaction
+        yield '], "next": null}'
+
+    return StreamingResponse(stream(), media_type='application/json')